@@ -1,29 +1,85 @@
 import requests
-from typing import Optional, Dict, List
+import asyncio
+import random
+import httpx
+from typing import Callable, Optional, Dict, List
 import json
+import os
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from http_client import build_async_client, timeout_for
+from metrics import should_log_body
+from phones import PhoneIndex, normalize_phone
+from bulk_access import AccessJournal
+
+# Предельный размер снимка с камеры
+SNAPSHOT_MAX_BYTES = int(os.getenv('SNAPSHOT_MAX_BYTES', str(10 * 1024 * 1024)))
 
 class ApiClient:
-    SUPER_USER = '+79953828610'
-    
-    def __init__(self, base_url: str, api_token: str):
+    def __init__(
+        self,
+        base_url: str,
+        api_token: str,
+        phones: Optional[PhoneIndex] = None,
+        access_journal: Optional[AccessJournal] = None
+    ):
         self.base_url = base_url
+        # Суперпользователи и известные жильцы из domophone.db
+        self.phones = phones if phones is not None else PhoneIndex()
+        # Известное состояние доступа; открывается при первой выдаче или отзыве
+        self._access_journal = access_journal
         self.headers = {
             'x-api-key': api_token,
             'Content-Type': 'application/json'
         }
+        self._access_listeners: List[Callable[[str], None]] = []
+    
+    def add_access_listener(self, callback: Callable[[str], None]):
+        """Подписка на изменение прав доступа пользователя (получает телефон)"""
+        self._access_listeners.append(callback)
+    
+    def _record_access(self, phone: str, domophone_id: str, granted: bool):
+        """Сохранение нового состояния доступа: по нему массовые задания пропускают выполненные пары"""
+        try:
+            if self._access_journal is None:
+                self._access_journal = AccessJournal(self.phones.path)
+            self._access_journal.set_state([(phone, domophone_id)], granted)
+        except Exception as e:
+            print(f"Access state error: {e}")
+    
+    def _notify_access_change(self, phone: str):
+        for callback in self._access_listeners:
+            try:
+                callback(phone)
+            except Exception as e:
+                print(f"Access listener error: {e}")
     
     def is_super_user(self, phone: str) -> bool:
         """Проверка является ли пользователь суперпользователем"""
-        return phone == self.SUPER_USER
+        return self.phones.is_super_user(phone)
+    
+    def _known_tenant(self, phone: str) -> Optional[Dict]:
+        """Данные жильца из локального индекса, без запроса к API"""
+        tenant_id = self.phones.tenant_for(phone)
+        if tenant_id is None:
+            return None
+        return {
+            'tenant_id': tenant_id,
+            'phone': phone,
+            'name': 'Домофон',
+            'id': str(tenant_id)
+        }
     
     def check_tenant(self, phone: str) -> Optional[Dict]:
         """Проверка и авторизация пользователя по номеру телефона"""
         try:
+            phone = normalize_phone(phone)
+            if phone is None:
+                return None
             if self.is_super_user(phone):
                 return {'phone': phone, 'is_super_user': True}
-            
-            # Форматируем номер телефона
-            phone = phone.replace('+', '')
+            known = self._known_tenant(phone)
+            if known is not None:
+                return known
             
             payload = {
                 "phone": phone
@@ -36,7 +92,8 @@ class ApiClient:
             )
             
             print(f"Response status: {response.status_code}")
-            print(f"Response text: {response.text}")
+            if should_log_body():
+                print(f"Response text: {response.text}")
             
             if response.status_code == 200:
                 data = response.json()
@@ -56,7 +113,9 @@ class ApiClient:
         """Получение списка доступных домофонов для пользователя"""
         try:
             # Форматируем номер телефона
-            phone = phone.replace('+', '')
+            phone = normalize_phone(phone)
+            if phone is None:
+                return []
             
             # Получаем информацию о пользователе
             response = requests.post(
@@ -66,7 +125,8 @@ class ApiClient:
             )
             
             print(f"Response status: {response.status_code}")
-            print(f"Response text: {response.text}")
+            if should_log_body():
+                print(f"Response text: {response.text}")
             
             if response.status_code == 200:
                 data = response.json()
@@ -83,26 +143,35 @@ class ApiClient:
             return []
     
     def get_camera_snapshot(self, domophone_id: str, phone: str) -> Optional[bytes]:
-        """Получение снимка с камеры домофона"""
+        """Получение снимка с камеры домофона потоком, не больше SNAPSHOT_MAX_BYTES"""
         try:
             # Форматируем номер телефона
-            phone = phone.replace('+', '')
+            phone = normalize_phone(phone)
+            if phone is None:
+                return None
             
             payload = {
                 "phone": phone,
                 "domophone_id": domophone_id
             }
             
-            response = requests.post(
+            with requests.post(
                 f"{self.base_url}/get-snapshot",
                 headers=self.headers,
-                json=payload
-            )
-            
-            if response.status_code == 200:
-                return response.content
-            print(f"Get snapshot response: {response.status_code}, {response.text}")
-            return None
+                json=payload,
+                stream=True
+            ) as response:
+                if response.status_code != 200:
+                    print(f"Get snapshot response: {response.status_code}, {response.text}")
+                    return None
+                
+                snapshot = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    snapshot += chunk
+                    if len(snapshot) > SNAPSHOT_MAX_BYTES:
+                        print(f"Snapshot {domophone_id} is larger than {SNAPSHOT_MAX_BYTES} bytes")
+                        return None
+                return bytes(snapshot)
         except Exception as e:
             print(f"Get snapshot error: {e}")
             return None
@@ -111,7 +180,9 @@ class ApiClient:
         """Открытие двери домофона"""
         try:
             # Форматируем номер телефона
-            phone = phone.replace('+', '')
+            phone = normalize_phone(phone)
+            if phone is None:
+                return False
             
             payload = {
                 "phone": phone,
@@ -133,6 +204,9 @@ class ApiClient:
 
     def grant_access(self, phone: str, domophone_id: str) -> bool:
         """Предоставление доступа пользователю (только для суперпользователя)"""
+        phone = normalize_phone(phone)
+        if phone is None:
+            return False
         try:
             response = requests.get(
                 f"{self.base_url}/grant-access",
@@ -142,13 +216,20 @@ class ApiClient:
                 },
                 headers=self.headers
             )
-            return response.status_code == 200
+            if response.status_code == 200:
+                self._record_access(phone, domophone_id, True)
+                self._notify_access_change(phone)
+                return True
+            return False
         except Exception as e:
             print(f"Grant access error: {e}")
             return False
 
     def revoke_access(self, phone: str, domophone_id: str) -> bool:
         """Отзыв доступа у пользователя (только для суперпользователя)"""
+        phone = normalize_phone(phone)
+        if phone is None:
+            return False
         try:
             response = requests.get(
                 f"{self.base_url}/revoke-access",
@@ -158,7 +239,215 @@ class ApiClient:
                 },
                 headers=self.headers
             )
-            return response.status_code == 200
+            if response.status_code == 200:
+                self._record_access(phone, domophone_id, False)
+                self._notify_access_change(phone)
+                return True
+            return False
         except Exception as e:
             print(f"Revoke access error: {e}")
-            return False 
\ No newline at end of file
+            return False
+
+
+class AsyncApiClient(ApiClient):
+    """Асинхронный клиент API с пулом соединений, повторами и предохранителем"""
+    
+    def __init__(
+        self,
+        base_url: str,
+        api_token: str,
+        max_retries: int = 2,
+        backoff_base: float = 0.2,
+        backoff_cap: float = 2.0,
+        breaker: Optional[CircuitBreaker] = None,
+        phones: Optional[PhoneIndex] = None,
+        access_journal: Optional[AccessJournal] = None
+    ):
+        super().__init__(base_url, api_token, phones, access_journal)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = breaker or CircuitBreaker()
+        self.client: Optional[httpx.AsyncClient] = None
+    
+    async def start(self):
+        """Создание пула соединений"""
+        if self.client is None:
+            self.client = build_async_client(headers=self.headers)
+    
+    async def close(self):
+        """Закрытие пула соединений"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    async def __aenter__(self):
+        await self.start()
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.close()
+    
+    async def _request(
+        self, method: str, endpoint: str, idempotent: bool, stream: bool = False, **kwargs
+    ) -> httpx.Response:
+        """Запрос к API; повторяются только идемпотентные вызовы.
+        При stream=True тело не читается, ответ закрывает вызывающий"""
+        await self.start()
+        attempts = self.max_retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            self.breaker.check()
+            try:
+                request = self.client.build_request(
+                    method,
+                    f"{self.base_url}/{endpoint}",
+                    timeout=timeout_for(endpoint),
+                    **kwargs
+                )
+                response = await self.client.send(request, stream=stream)
+            except httpx.TransportError:
+                self.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+            except Exception:
+                # Ответ, который не удалось прочитать (DecodingError, TooManyRedirects) - тоже сбой
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # Отмененный запрос ничего не говорит о состоянии API, но пробный слот освобождается
+                self.breaker.release()
+                raise
+            else:
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    return response
+                await response.aclose()
+            # Экспоненциальная задержка с полным джиттером
+            delay = min(self.backoff_cap, self.backoff_base * 2 ** attempt)
+            await asyncio.sleep(random.uniform(0, delay))
+    
+    async def check_tenant(self, phone: str) -> Optional[Dict]:
+        """Проверка и авторизация пользователя по номеру телефона"""
+        try:
+            phone = normalize_phone(phone)
+            if phone is None:
+                return None
+            if self.is_super_user(phone):
+                return {'phone': phone, 'is_super_user': True}
+            known = self._known_tenant(phone)
+            if known is not None:
+                return known
+            
+            response = await self._request(
+                'POST', 'check-tenant', idempotent=True, json={"phone": phone}
+            )
+            
+            if response.status_code == 200:
+                data = response.json()
+                return {
+                    'tenant_id': data.get('tenant_id'),
+                    'phone': phone,
+                    'name': 'Домофон',
+                    'id': str(data.get('tenant_id'))
+                }
+            print(f"Check tenant response: {response.status_code}, {response.text}")
+            return None
+        except CircuitOpenError:
+            return None
+        except Exception as e:
+            print(f"Check tenant error: {e}")
+            return None
+    
+    async def get_tenant_domophones(self, phone: str) -> List[Dict]:
+        """Получение списка доступных домофонов для пользователя"""
+        tenant = await self.check_tenant(phone)
+        if not tenant or not tenant.get('tenant_id'):
+            return []
+        tenant_id = tenant['tenant_id']
+        return [{
+            'name': f'Домофон #{tenant_id}',
+            'id': str(tenant_id),
+            'tenant_id': tenant_id
+        }]
+    
+    async def get_camera_snapshot(self, domophone_id: str, phone: str) -> Optional[bytes]:
+        """Получение снимка с камеры домофона потоком, не больше SNAPSHOT_MAX_BYTES"""
+        try:
+            phone = normalize_phone(phone)
+            if phone is None:
+                return None
+            response = await self._request(
+                'POST', 'get-snapshot', idempotent=True, stream=True,
+                json={"phone": phone, "domophone_id": domophone_id}
+            )
+            try:
+                if response.status_code != 200:
+                    await response.aread()
+                    print(f"Get snapshot response: {response.status_code}, {response.text}")
+                    return None
+                
+                snapshot = bytearray()
+                async for chunk in response.aiter_bytes():
+                    snapshot += chunk
+                    if len(snapshot) > SNAPSHOT_MAX_BYTES:
+                        print(f"Snapshot {domophone_id} is larger than {SNAPSHOT_MAX_BYTES} bytes")
+                        return None
+                return bytes(snapshot)
+            finally:
+                await response.aclose()
+        except CircuitOpenError:
+            return None
+        except Exception as e:
+            print(f"Get snapshot error: {e}")
+            return None
+    
+    async def open_domophone(self, domophone_id: str, phone: str) -> bool:
+        """Открытие двери домофона (без повторов: команда не идемпотентна)"""
+        try:
+            phone = normalize_phone(phone)
+            if phone is None:
+                return False
+            response = await self._request(
+                'POST', 'open-door', idempotent=False,
+                json={"phone": phone, "domophone_id": domophone_id}
+            )
+            
+            if response.status_code != 200:
+                print(f"Open door response: {response.status_code}, {response.text}")
+            return response.status_code == 200
+        except CircuitOpenError:
+            return False
+        except Exception as e:
+            print(f"Open door error: {e}")
+            return False
+    
+    async def _change_access(self, endpoint: str, phone: str, domophone_id: str) -> bool:
+        phone = normalize_phone(phone)
+        if phone is None:
+            return False
+        try:
+            response = await self._request(
+                'GET', endpoint, idempotent=True,
+                params={'phone': phone, 'domophone_id': domophone_id}
+            )
+            if response.status_code == 200:
+                await asyncio.to_thread(self._record_access, phone, domophone_id, endpoint == 'grant-access')
+                self._notify_access_change(phone)
+                return True
+            return False
+        except CircuitOpenError:
+            return False
+        except Exception as e:
+            print(f"Change access error ({endpoint}): {e}")
+            return False
+    
+    async def grant_access(self, phone: str, domophone_id: str) -> bool:
+        """Предоставление доступа пользователю (только для суперпользователя)"""
+        return await self._change_access('grant-access', phone, domophone_id)
+    
+    async def revoke_access(self, phone: str, domophone_id: str) -> bool:
+        """Отзыв доступа у пользователя (только для суперпользователя)"""
+        return await self._change_access('revoke-access', phone, domophone_id)
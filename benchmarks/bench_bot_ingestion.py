@@ -0,0 +1,172 @@
+"""Сравнение режимов получения обновлений бота: long polling и webhook.
+
+Фейковый Telegram раздает обновления через getUpdates; в режиме webhook те же
+обновления отправляются POST-запросами на /telegram/webhook webhook_server.
+Измеряется задержка от появления обновления до вызова обработчика и доля CPU.
+
+Запуск: python -m benchmarks.bench_bot_ingestion [обновлений] [обновлений в секунду]
+"""
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+import uvicorn
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application, MessageHandler, filters
+
+from benchmarks.stub_api import percentile, start_app
+
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+TOKEN = '123:bench'
+
+
+def make_update(update_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': update_id % 100, 'type': 'private'},
+            'text': f'ping {time.perf_counter()}'
+        }
+    }
+
+
+def create_fake_telegram(updates: asyncio.Queue) -> web.Application:
+    """Telegram, который отдает обновления через long polling"""
+
+    async def handle_method(request):
+        method = request.match_info['method']
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'getUpdates':
+            result = []
+            try:
+                result.append(await asyncio.wait_for(updates.get(), 1))
+                while not updates.empty():
+                    result.append(updates.get_nowait())
+            except asyncio.TimeoutError:
+                pass
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle_method)
+    return app
+
+
+def build_application(base_url: str, latencies: list, done: asyncio.Event, total: int) -> Application:
+    async def handle(update, context):
+        latencies.append(time.perf_counter() - float(update.message.text.split()[1]))
+        if len(latencies) >= total:
+            done.set()
+
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(base_url)
+        .concurrent_updates(64)
+        .build()
+    )
+    app.add_handler(MessageHandler(filters.ALL, handle))
+    return app
+
+
+async def run_polling_mode(total: int, rate: float):
+    updates = asyncio.Queue()
+    runner, base_url = await start_app(create_fake_telegram(updates), '127.0.0.1', 0)
+    latencies, done = [], asyncio.Event()
+    app = build_application(f'{base_url}/bot', latencies, done, total)
+    await app.initialize()
+    await app.start()
+    await app.updater.start_polling(poll_interval=0, timeout=1)
+    try:
+        cpu_started, started = time.process_time(), time.perf_counter()
+        for update_id in range(1, total + 1):
+            updates.put_nowait(make_update(update_id))
+            await asyncio.sleep(1 / rate)
+        await done.wait()
+        cpu, wall = time.process_time() - cpu_started, time.perf_counter() - started
+    finally:
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        await runner.cleanup()
+    return latencies, cpu / wall
+
+
+async def run_webhook_mode(total: int, rate: float):
+    updates = asyncio.Queue()
+    runner, base_url = await start_app(create_fake_telegram(updates), '127.0.0.1', 0)
+    latencies, done = [], asyncio.Event()
+    app = build_application(f'{base_url}/bot', latencies, done, total)
+
+    data_dir = tempfile.mkdtemp()
+    os.environ['NOTIFY_QUEUE_DB'] = os.path.join(data_dir, 'notifications.db')
+    os.environ['DOMOPHONE_DB'] = os.path.join(data_dir, 'domophone.db')
+    os.environ['EVENT_LOG_DB'] = os.path.join(data_dir, 'events.db')
+    os.environ.setdefault('TELEGRAM_TOKEN', TOKEN)
+    # Доставка вызовов в этом замере не нужна
+    os.environ['DELIVERY_IN_PROCESS'] = '0'
+    import webhook_server
+
+    class WebhookBot:
+        """То же, что DomophoneBot.process_webhook_update, но для тестового приложения"""
+
+        async def process_webhook_update(self, data):
+            await app.update_queue.put(Update.de_json(data, app.bot))
+
+    server = uvicorn.Server(uvicorn.Config(webhook_server.app, host='127.0.0.1', port=0, log_level='warning'))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    webhook_server.telegram_bot = WebhookBot()
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    await app.initialize()
+    await app.start()
+    try:
+        async with httpx.AsyncClient() as client:
+            cpu_started, started = time.process_time(), time.perf_counter()
+            posts = []
+            for update_id in range(1, total + 1):
+                posts.append(asyncio.create_task(client.post(
+                    f'http://127.0.0.1:{port}/telegram/webhook', json=make_update(update_id)
+                )))
+                await asyncio.sleep(1 / rate)
+            await asyncio.gather(*posts)
+            await done.wait()
+            cpu, wall = time.process_time() - cpu_started, time.perf_counter() - started
+    finally:
+        await app.stop()
+        await app.shutdown()
+        webhook_server.telegram_bot = None
+        server.should_exit = True
+        await server_task
+        await runner.cleanup()
+    return latencies, cpu / wall
+
+
+def report(name: str, latencies: list, cpu_share: float):
+    print(
+        f'{name:<8} n={len(latencies)} p50={percentile(latencies, 50) * 1000:.1f}ms '
+        f'p99={percentile(latencies, 99) * 1000:.1f}ms cpu={cpu_share * 100:.0f}%'
+    )
+
+
+async def main(total: int, rate: float):
+    report('polling', *await run_polling_mode(total, rate))
+    report('webhook', *await run_webhook_mode(total, rate))
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    asyncio.run(main(total, rate))
@@ -0,0 +1,105 @@
+"""Масштабирование бота по рабочим процессам.
+
+Обновления /domofons от разных чатов раздаются BotCluster, обработчики
+ходят в заглушку API и отвечают в фейковый Telegram; пропускная способность
+считается по числу ответов.
+
+Запуск: python -m benchmarks.bench_cluster [обновлений] [макс. процессов]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from telegram import Update
+
+from benchmarks.stub_api import start_stub_api, start_stub_telegram
+from bot_cluster import BotCluster
+from session_store import SessionStore
+
+CHATS = 1000
+
+
+def create_bench_bot():
+    """Бот рабочего процесса, направленный на локальную заглушку API"""
+    import bot
+    bot.settings.API_URL = os.environ['BENCH_API_URL']
+    return bot.DomophoneBot()
+
+
+def make_update(update_id: int) -> Update:
+    chat_id = update_id % CHATS + 1
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+            'text': '/domofons',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 9}]
+        }
+    }, None)
+
+
+async def measure(workers: int, total: int, tg_runner) -> float:
+    calls = tg_runner.app['calls']
+    calls.clear()
+    cluster = BotCluster(workers=workers, bot_factory=create_bench_bot)
+    cluster.start()
+    try:
+        # Прогрев: процессы поднялись и обработали по одному обновлению
+        for update_id in range(workers):
+            cluster.route(make_update(update_id))
+        while calls.get('sendMessage', 0) < workers:
+            await asyncio.sleep(0.05)
+
+        calls.clear()
+        started = time.perf_counter()
+        for update_id in range(total):
+            await asyncio.to_thread(cluster.route, make_update(update_id))
+        while calls.get('sendMessage', 0) < total:
+            await asyncio.sleep(0.01)
+        return total / (time.perf_counter() - started)
+    finally:
+        await asyncio.to_thread(cluster.stop)
+
+
+async def main(total: int, max_workers: int):
+    data_dir = tempfile.mkdtemp()
+    os.environ['DOMOPHONE_DB'] = os.path.join(data_dir, 'domophone.db')
+    os.environ['EVENT_LOG_DB'] = os.path.join(data_dir, 'events.db')
+    sessions = SessionStore(os.environ['DOMOPHONE_DB'])
+    for chat_id in range(1, CHATS + 1):
+        sessions.save(chat_id, chat_id, f'7900{chat_id:07d}')
+    sessions.close()
+
+    api_runner, api_url = await start_stub_api(latency=0.002, apartments=3)
+    tg_runner, tg_url = await start_stub_telegram(latency=0.002)
+    os.environ['BENCH_API_URL'] = api_url
+    os.environ['TELEGRAM_API_URL'] = tg_url
+    os.environ.setdefault('TELEGRAM_TOKEN', '123:bench')
+    # Общий кэш отключается, чтобы каждый ответ требовал работы обработчика
+    os.environ['DOMOFONS_CACHE_TTL'] = '0'
+    # Общий лимит Telegram делится между процессами; здесь измеряются обработчики, а не лимит
+    os.environ.setdefault('TELEGRAM_GLOBAL_RATE', '100000')
+    os.environ.setdefault('TELEGRAM_GLOBAL_BURST', '1000')
+
+    try:
+        baseline = None
+        workers = 1
+        while workers <= max_workers:
+            throughput = await measure(workers, total, tg_runner)
+            baseline = baseline or throughput
+            print(f'workers={workers} throughput={throughput:.0f} updates/s scaling={throughput / baseline:.2f}x')
+            workers *= 2
+    finally:
+        await api_runner.cleanup()
+        await tg_runner.cleanup()
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    asyncio.run(main(total, max_workers))
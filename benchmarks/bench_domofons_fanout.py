@@ -0,0 +1,67 @@
+"""Проверка параллельного получения домофонов для жильца с 50 квартирами.
+
+Запуск: python -m benchmarks.bench_domofons_fanout
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+os.environ.setdefault('DOMOFONS_FETCH_CONCURRENCY', '50')
+# Сессии и журнал событий бота пишутся во временный каталог, а не в рабочий
+_data_dir = tempfile.mkdtemp()
+os.environ.setdefault('DOMOPHONE_DB', os.path.join(_data_dir, 'domophone.db'))
+os.environ.setdefault('EVENT_LOG_DB', os.path.join(_data_dir, 'events.db'))
+
+import bot as bot_module
+from benchmarks.stub_api import start_stub_api
+
+APARTMENTS = 50
+# Заглушка работает в том же процессе, и 50 соединений добавляют около 0.1с;
+# при задержке в секунду это не мешает отличить один проход от двух
+LATENCY = 1.0
+MAX_FANOUT_ROUND_TRIPS = 1.3
+
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+
+async def main():
+    # Постоянная задержка без разброса: время прохода не зависит от случайно медленного запроса
+    runner, base_url = await start_stub_api(latency=lambda: LATENCY, apartments=APARTMENTS)
+    bot_module.settings.API_URL = base_url
+    domophone_bot = bot_module.DomophoneBot()
+    await domophone_bot.post_init(domophone_bot.app)
+    # Начало прохода по квартирам - первый запрос домофонов квартиры
+    fanout_started = []
+    fetch_apartment_domofons = domophone_bot.fetch_apartment_domofons
+
+    async def timed_fetch(*args):
+        if not fanout_started:
+            fanout_started.append(time.perf_counter())
+        return await fetch_apartment_domofons(*args)
+
+    domophone_bot.fetch_apartment_domofons = timed_fetch
+    try:
+        started = time.perf_counter()
+        domofons = await domophone_bot.fetch_domofons(tenant_id=1)
+        finished = time.perf_counter()
+    finally:
+        await domophone_bot.post_shutdown(domophone_bot.app)
+        await runner.cleanup()
+
+    assert [d['id'] for d in domofons] == list(range(1, APARTMENTS + 1)), 'порядок нарушен'
+    # Список квартир + один параллельный проход по квартирам. Сам проход должен занять
+    # одну задержку API плюс накладные расходы клиента и заглушки; если часть запросов
+    # пойдет друг за другом, порог будет превышен
+    elapsed = finished - started
+    fanout = finished - fanout_started[0]
+    print(
+        f'apartments={APARTMENTS} elapsed={elapsed * 1000:.1f}ms fanout={fanout * 1000:.1f}ms '
+        f'round_trips={elapsed / LATENCY:.2f}'
+    )
+    assert fanout < MAX_FANOUT_ROUND_TRIPS * LATENCY, 'запросы по квартирам выполняются последовательно'
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
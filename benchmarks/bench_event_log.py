@@ -0,0 +1,67 @@
+"""Журнал событий: запись пачками и постраничное чтение истории жильца.
+
+В журнал записываются события за 12 месяцев для многих жильцов. Затем замеряется
+чтение первой страницы /history и страниц в глубине истории, где переход
+выполняется по курсору (ts, id).
+
+Запуск: python -m benchmarks.bench_event_log [событий] [жильцов]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.stub_api import percentile
+from event_log import EVENT_CALL, EVENT_OPEN, EventLog
+
+DAY = 86400
+
+
+def fill(log: EventLog, total: int, tenants: int) -> float:
+    """Событий за последние 12 месяцев; возвращает скорость записи, событий/с"""
+    now = time.time()
+    started = time.perf_counter()
+    for i in range(total):
+        kind = EVENT_CALL if i % 3 else EVENT_OPEN
+        log.append(kind, random.randint(1, tenants), random.randint(1, 1000), ts=now - random.random() * 365 * DAY)
+        # Фоновой задачи записи здесь нет, пачки записываются по мере накопления
+        if (i + 1) % log.flush_size == 0:
+            log.flush()
+    log.flush()
+    return total / (time.perf_counter() - started)
+
+
+def measure_pages(log: EventLog, tenants: int, samples: int = 200):
+    first, deep = [], []
+    for _ in range(samples):
+        tenant_id = random.randint(1, tenants)
+        started = time.perf_counter()
+        _, cursor = log.tenant_history(tenant_id)
+        first.append(time.perf_counter() - started)
+        # Проход по всей истории жильца: последние страницы лежат в самых старых месяцах
+        while cursor is not None:
+            started = time.perf_counter()
+            _, cursor = log.tenant_history(tenant_id, before=cursor)
+            deep.append(time.perf_counter() - started)
+    return first, deep
+
+
+def main(total: int, tenants: int):
+    path = os.path.join(tempfile.mkdtemp(), 'events.db')
+    log = EventLog(path, retention_days=400, flush_size=5000)
+    rate = fill(log, total, tenants)
+    print(f'запись: {rate:.0f} событий/с, месяцев: {len(log._partition_names())}')
+    first, deep = measure_pages(log, tenants)
+    for name, latencies in (('первая страница', first), ('следующие', deep)):
+        print(
+            f'{name:<16} n={len(latencies)} p50={percentile(latencies, 50) * 1000:.2f}ms '
+            f'p99={percentile(latencies, 99) * 1000:.2f}ms'
+        )
+    log.close()
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    tenants = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+    main(total, tenants)
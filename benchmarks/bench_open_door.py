@@ -0,0 +1,74 @@
+"""Сравнение открытия двери: новый httpx.AsyncClient на запрос против общего пула.
+
+Запуск: python -m benchmarks.bench_open_door [количество запросов] [параллельность]
+"""
+import asyncio
+import sys
+import time
+
+import httpx
+
+from benchmarks.stub_api import percentile, start_stub_api
+from http_client import build_async_client, timeout_for
+
+HEADERS = {'x-api-key': 'bench', 'Content-Type': 'application/json'}
+
+
+async def open_door_per_request(base_url: str) -> float:
+    started = time.perf_counter()
+    async with httpx.AsyncClient() as client:
+        await client.post(
+            f'{base_url}/domo.domofon/1/open',
+            headers=HEADERS,
+            json={'door_id': 1},
+            params={'tenant_id': 1}
+        )
+    return time.perf_counter() - started
+
+
+async def open_door_pooled(client: httpx.AsyncClient, base_url: str) -> float:
+    started = time.perf_counter()
+    await client.post(
+        f'{base_url}/domo.domofon/1/open',
+        json={'door_id': 1},
+        params={'tenant_id': 1},
+        timeout=timeout_for('open')
+    )
+    return time.perf_counter() - started
+
+
+async def run_batches(make_call, total: int, concurrency: int):
+    latencies = []
+    for _ in range(0, total, concurrency):
+        latencies.extend(await asyncio.gather(*(make_call() for _ in range(concurrency))))
+    return latencies
+
+
+def report(name: str, latencies):
+    print(
+        f'{name:<12} n={len(latencies)} '
+        f'p50={percentile(latencies, 50) * 1000:.2f}ms '
+        f'p99={percentile(latencies, 99) * 1000:.2f}ms'
+    )
+
+
+async def main(total: int, concurrency: int):
+    runner, base_url = await start_stub_api()
+    try:
+        per_request = await run_batches(
+            lambda: open_door_per_request(base_url), total, concurrency
+        )
+        async with build_async_client(headers=HEADERS) as client:
+            pooled = await run_batches(
+                lambda: open_door_pooled(client, base_url), total, concurrency
+            )
+    finally:
+        await runner.cleanup()
+    report('per-request', per_request)
+    report('pooled', pooled)
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    asyncio.run(main(total, concurrency))
@@ -0,0 +1,99 @@
+"""Симуляция доставки уведомлений через SendScheduler при 1000 звонков в минуту.
+
+Фейковый Telegram отвечает RetryAfter, если бот превышает 30 сообщений
+в секунду или 1 сообщение в секунду в один чат. Параллельно идут
+информационные ответы бота.
+
+Запуск: python -m benchmarks.bench_send_scheduler [секунд] [звонков в минуту]
+"""
+import asyncio
+import logging
+import random
+import sys
+import time
+from collections import defaultdict, deque
+
+from telegram.error import RetryAfter
+
+from benchmarks.stub_api import percentile
+from send_scheduler import PRIORITY_CALL, PRIORITY_INFO, SendScheduler
+
+CHATS = 90
+DOMOFONS = 60
+SEND_LATENCY = 0.05
+
+logging.getLogger('send_scheduler').setLevel(logging.ERROR)
+
+
+class FakeTelegram:
+    """Telegram с жесткими лимитами и ответом 429"""
+
+    def __init__(self):
+        self.global_sends = deque()
+        self.chat_sends = defaultdict(deque)
+        self.too_many = 0
+
+    async def send(self, chat_id):
+        now = time.monotonic()
+        while self.global_sends and now - self.global_sends[0] > 1:
+            self.global_sends.popleft()
+        chat = self.chat_sends[chat_id]
+        while chat and now - chat[0] > 1:
+            chat.popleft()
+        if len(self.global_sends) >= 30 or len(chat) >= 3:
+            self.too_many += 1
+            raise RetryAfter(1)
+        self.global_sends.append(now)
+        chat.append(now)
+        await asyncio.sleep(SEND_LATENCY * random.uniform(0.5, 1.5))
+
+
+async def main(duration: float, rings_per_minute: int):
+    telegram = FakeTelegram()
+    scheduler = SendScheduler()
+    latencies = {PRIORITY_CALL: [], PRIORITY_INFO: []}
+    errors = 0
+
+    async def deliver(chat_id, priority, coalesce_key=None):
+        nonlocal errors
+        started = time.monotonic()
+        try:
+            await scheduler.send(
+                chat_id, lambda: telegram.send(chat_id), priority=priority, coalesce_key=coalesce_key
+            )
+        except RetryAfter:
+            errors += 1
+            return
+        latencies[priority].append(time.monotonic() - started)
+
+    tasks = []
+    interval = 60 / rings_per_minute
+    started = time.monotonic()
+    while time.monotonic() - started < duration:
+        domofon_id = random.randrange(DOMOFONS)
+        # Жильцы одного подъезда получают звонок одновременно
+        for chat_id in range(domofon_id * CHATS // DOMOFONS, (domofon_id + 1) * CHATS // DOMOFONS):
+            tasks.append(asyncio.create_task(
+                deliver(chat_id, PRIORITY_CALL, coalesce_key=f'ring:{chat_id}:{domofon_id}')
+            ))
+        # Информационные ответы бота на фоне
+        tasks.append(asyncio.create_task(deliver(random.randrange(CHATS), PRIORITY_INFO)))
+        await asyncio.sleep(interval)
+    await asyncio.gather(*tasks)
+    await scheduler.stop()
+
+    stats = scheduler.stats()
+    print(f'duration={duration}s rings/min={rings_per_minute} {stats} telegram_429={telegram.too_many} failed={errors}')
+    for priority, name in ((PRIORITY_CALL, 'calls'), (PRIORITY_INFO, 'info')):
+        values = latencies[priority]
+        if values:
+            print(
+                f'{name:<6} n={len(values)} p50={percentile(values, 50) * 1000:.0f}ms '
+                f'p99={percentile(values, 99) * 1000:.0f}ms max={max(values) * 1000:.0f}ms'
+            )
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+    rings_per_minute = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    asyncio.run(main(duration, rings_per_minute))
@@ -0,0 +1,95 @@
+"""Отправка снимков с камер в Telegram: как есть против пережатия в пуле процессов.
+
+Заглушка API отдает настоящий JPEG высокого разрешения (нужен Pillow); снимки
+разных камер скачиваются, обрабатываются и загружаются в фейковый Telegram.
+Печатаются байты загрузки, задержка и пик памяти главного процесса.
+
+Запуск: python -m benchmarks.bench_snapshot_processing [снимков] [параллельность]
+"""
+import asyncio
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.stub_api import percentile, start_stub_api, start_stub_telegram
+
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+os.environ.setdefault('DOMOPHONE_DB', os.path.join(tempfile.mkdtemp(), 'domophone.db'))
+
+
+def make_camera_frame(width: int = 3840, height: int = 2160) -> bytes:
+    """Кадр 4K с шумом: плохо сжимается, как кадр реальной камеры"""
+    from PIL import Image
+
+    image = Image.effect_noise((width, height), 64).convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=92)
+    return output.getvalue()
+
+
+async def measure(name: str, processor, api_client, bot, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    uploaded = 0
+
+    async def one(i: int):
+        nonlocal uploaded
+        async with semaphore:
+            started = time.perf_counter()
+            photo = await processor.load(lambda: api_client.get_camera_snapshot(str(i), '79000000000'))
+            await bot.send_photo(chat_id=1, photo=photo)
+            uploaded += len(photo)
+            latencies.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    processor.close()
+    print(
+        f'{name:<12} uploaded={uploaded / total / 1024:.0f}KiB/снимок '
+        f'p50={percentile(latencies, 50) * 1000:.0f}ms p99={percentile(latencies, 99) * 1000:.0f}ms '
+        f'total={elapsed:.2f}s peak_memory={peak / 1024 / 1024:.1f}MiB'
+    )
+
+
+async def main(total: int, concurrency: int):
+    from telegram import Bot
+
+    from api_client import AsyncApiClient
+    from snapshot_processing import PILLOW_AVAILABLE, SnapshotProcessor
+
+    if not PILLOW_AVAILABLE:
+        print('Pillow не установлен: пережатие отключено, сравнивать нечего')
+        return
+
+    frame = make_camera_frame()
+    print(f'кадр камеры: {len(frame) / 1024:.0f}KiB')
+    api_runner, api_url = await start_stub_api(latency=0.02, snapshot=frame)
+    # Локальная загрузка не упирается в канал: реальную выгоду показывает uploaded
+    tg_runner, tg_url = await start_stub_telegram(latency=0.05)
+    try:
+        async with AsyncApiClient(api_url, 'bench') as api_client:
+            async with Bot(token='123:bench', base_url=tg_url) as bot:
+                await measure(
+                    'passthrough', SnapshotProcessor(enabled=False), api_client, bot, total, concurrency
+                )
+                await measure(
+                    'transcoded', SnapshotProcessor(enabled=True), api_client, bot, total, concurrency
+                )
+    finally:
+        await api_runner.cleanup()
+        await tg_runner.cleanup()
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    asyncio.run(main(total, concurrency))
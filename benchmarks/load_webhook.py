@@ -0,0 +1,105 @@
+"""Нагрузочный тест webhook входящих вызовов против локальных заглушек.
+
+Запуск: python -m benchmarks.load_webhook [количество вызовов] [параллельность]
+"""
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+import uvicorn
+
+from benchmarks.stub_api import percentile, start_stub_api, start_stub_telegram
+
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logging.getLogger('webhook_server').setLevel(logging.ERROR)
+
+TENANTS = 500
+
+
+async def fire_calls(base_url: str, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+
+    async def one_call(client: httpx.AsyncClient, i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(
+                f'{base_url}/webhook/call',
+                json={'domofon_id': str(i % 50 + 1), 'tenant_id': str(i % TENANTS + 1)}
+            )
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one_call(client, i) for i in range(total)))
+        elapsed = time.perf_counter() - started
+    return latencies, statuses, elapsed
+
+
+async def main(total: int, concurrency: int):
+    api_runner, api_url = await start_stub_api(latency=0.05)
+    tg_runner, tg_url = await start_stub_telegram(latency=0.05)
+    os.environ['DOMOPHONE_API_URL'] = api_url
+    os.environ['DOMOPHONE_API_TOKEN'] = 'bench'
+    os.environ['TELEGRAM_TOKEN'] = '123:bench'
+    os.environ['TELEGRAM_API_URL'] = tg_url
+    data_dir = tempfile.mkdtemp()
+    os.environ['NOTIFY_QUEUE_DB'] = os.path.join(data_dir, 'notifications.db')
+    os.environ['DOMOPHONE_DB'] = os.path.join(data_dir, 'domophone.db')
+    os.environ['EVENT_LOG_DB'] = os.path.join(data_dir, 'events.db')
+
+    import webhook_server
+
+    for tenant_id in range(1, TENANTS + 1):
+        webhook_server.session_store.save(100000 + tenant_id, tenant_id, f'7900{tenant_id:07d}')
+    webhook_server.session_store.flush()
+
+    config = uvicorn.Config(webhook_server.app, host='127.0.0.1', port=0, log_level='warning')
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    try:
+        latencies, statuses, elapsed = await fire_calls(f'http://127.0.0.1:{port}', total, concurrency)
+        drain_started = time.perf_counter()
+        while await asyncio.to_thread(webhook_server.notification_queue.depth):
+            await asyncio.sleep(0.05)
+        drain = time.perf_counter() - drain_started
+        stats = await asyncio.to_thread(webhook_server.delivery_worker.stats)
+        tg_calls = dict(tg_runner.app['calls'])
+        snapshot_stats = {
+            key: value for key, value in webhook_server.snapshots.stats().items()
+            if key in ('uploads', 'file_id_reused')
+        }
+    finally:
+        server.should_exit = True
+        await server_task
+        await api_runner.cleanup()
+        await tg_runner.cleanup()
+
+    print(f'calls={total} concurrency={concurrency} statuses={statuses}')
+    print(f'throughput={total / elapsed:.0f} req/s')
+    print(
+        f'ack p50={percentile(latencies, 50) * 1000:.1f}ms '
+        f'p99={percentile(latencies, 99) * 1000:.1f}ms'
+    )
+    print(f'telegram calls={tg_calls} snapshot cache={snapshot_stats}')
+    print(
+        f'background delivered={stats["delivered"]} retried={stats["retried"]} '
+        f'dead={stats["dead"]} drain={drain * 1000:.0f}ms'
+    )
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    asyncio.run(main(total, concurrency))
@@ -0,0 +1,258 @@
+"""Локальные симуляторы API домофонов и Telegram Bot API для бенчмарков.
+
+Задержка задается числом (среднее с разбросом ±20%) или функцией без аргументов,
+например lognormal(0.05, 0.5); доли ошибок 5xx и ответов 429 настраиваются
+отдельно. Симулятор можно запустить и отдельным процессом:
+
+    python -m benchmarks.stub_api --port 8081 --telegram-port 8082 --latency 0.05 --apartments 20
+"""
+import argparse
+import asyncio
+import io
+import math
+import random
+from typing import Callable, Optional, Union
+
+from aiohttp import web
+
+Latency = Union[float, Callable[[], float]]
+
+
+def lognormal(median: float, sigma: float = 0.5) -> Callable[[], float]:
+    """Логнормальная задержка: медиана median, длинный хвост при большом sigma"""
+    mu = math.log(median)
+    return lambda: random.lognormvariate(mu, sigma)
+
+
+def make_delay(latency: Latency) -> Callable[[], float]:
+    if callable(latency):
+        return latency
+    return lambda: latency * random.uniform(0.8, 1.2)
+
+
+def make_jpeg(size: int) -> bytes:
+    """Настоящий JPEG примерно заданного размера: снимок проходит через пережатие,
+    как кадр реальной камеры"""
+    from PIL import Image
+
+    def encode(side: int) -> bytes:
+        output = io.BytesIO()
+        Image.effect_noise((side, side), 64).convert('RGB').save(output, format='JPEG', quality=90)
+        return output.getvalue()
+
+    # Шум сжимается почти одинаково, поэтому сторона подбирается по пробному кадру
+    sample = 64
+    bytes_per_pixel = len(encode(sample)) / sample ** 2
+    return encode(max(sample // 4, int((size / bytes_per_pixel) ** 0.5)))
+
+
+def create_stub_api(
+    latency: Latency = 0.005,
+    apartments: int = 1,
+    domofons_per_apartment: int = 1,
+    doors_per_domofon: int = 1,
+    snapshot_bytes: int = 50_000,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    snapshot: Optional[bytes] = None
+) -> web.Application:
+    """Симулятор API домофонов; snapshot - готовое тело снимка вместо сгенерированного"""
+    delay = make_delay(latency)
+    if snapshot is None:
+        snapshot = make_jpeg(snapshot_bytes)
+    app = web.Application()
+    app['calls'] = {}
+    app['errors'] = {}
+
+    @web.middleware
+    async def simulate(request, handler):
+        await asyncio.sleep(delay())
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        app['calls'][route] = app['calls'].get(route, 0) + 1
+        roll = random.random()
+        if roll < rate_limit_rate:
+            app['errors'][429] = app['errors'].get(429, 0) + 1
+            return web.json_response({'detail': 'Too Many Requests'}, status=429, headers={'Retry-After': '1'})
+        if roll < rate_limit_rate + error_rate:
+            app['errors'][500] = app['errors'].get(500, 0) + 1
+            return web.json_response({'detail': 'Internal Server Error'}, status=500)
+        return await handler(request)
+
+    async def check_tenant(request):
+        payload = await request.json()
+        return web.json_response({'tenant_id': int(str(payload.get('phone', 1))[-6:]) or 1})
+
+    async def list_apartments(request):
+        return web.json_response([{'id': i} for i in range(1, apartments + 1)])
+
+    async def list_domofons(request):
+        apartment_id = int(request.match_info['apartment_id'])
+        return web.json_response([
+            {
+                'id': (apartment_id - 1) * domofons_per_apartment + i + 1,
+                'location': {'readable_address': f'ул. Тестовая, {apartment_id}', 'porch': i + 1},
+                'doors': [{'id': door + 1, 'name': f'Дверь {door + 1}'} for door in range(doors_per_domofon)]
+            }
+            for i in range(domofons_per_apartment)
+        ])
+
+    async def urls_on_type(request):
+        payload = await request.json()
+        return web.json_response([
+            {'id': i, 'jpeg': f'http://stub/snapshot/{i}.jpg'} for i in payload['intercoms_id']
+        ])
+
+    async def open_door(request):
+        return web.json_response({'msg': '✅ Дверь открыта'})
+
+    async def get_snapshot(request):
+        return web.Response(body=snapshot, content_type='image/jpeg')
+
+    async def change_access(request):
+        return web.json_response({'status': 'ok'})
+
+    app.middlewares.append(simulate)
+    app.router.add_post('/check-tenant', check_tenant)
+    app.router.add_get('/domo.apartment', list_apartments)
+    app.router.add_get('/domo.apartment/{apartment_id}/domofon', list_domofons)
+    app.router.add_post('/domo.domofon/urlsOnType', urls_on_type)
+    app.router.add_post('/domo.domofon/{domofon_id}/open', open_door)
+    app.router.add_post('/get-snapshot', get_snapshot)
+    app.router.add_get('/grant-access', change_access)
+    app.router.add_get('/revoke-access', change_access)
+    return app
+
+
+def create_stub_telegram(
+    latency: Latency = 0.01,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    retry_after: int = 1
+) -> web.Application:
+    """Симулятор Telegram Bot API: отвечает на методы минимальными объектами"""
+    delay = make_delay(latency)
+    app = web.Application()
+    app['calls'] = {}
+    app['errors'] = {}
+
+    def message(method: str) -> dict:
+        return {
+            'message_id': app['calls'][method],
+            'date': 0,
+            'chat': {'id': 1, 'type': 'private'},
+            'photo': [{'file_id': 'stub-file', 'file_unique_id': 'stub', 'width': 1, 'height': 1}]
+        }
+
+    async def handle_method(request):
+        await asyncio.sleep(delay())
+        method = request.match_info['method']
+        roll = random.random()
+        if roll < rate_limit_rate:
+            app['errors'][429] = app['errors'].get(429, 0) + 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {retry_after}',
+                'parameters': {'retry_after': retry_after}
+            }, status=429)
+        if roll < rate_limit_rate + error_rate:
+            app['errors'][500] = app['errors'].get(500, 0) + 1
+            return web.json_response(
+                {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}, status=500
+            )
+
+        app['calls'][method] = app['calls'].get(method, 0) + 1
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+        elif method == 'getUpdates':
+            result = []
+        elif method.startswith(('answer', 'set', 'delete')):
+            result = True
+        elif method == 'sendMediaGroup':
+            form = await request.post()
+            count = str(form.get('media', '')).count('"type"') or 1
+            result = [message(method) for _ in range(count)]
+        else:
+            result = message(method)
+        return web.json_response({'ok': True, 'result': result})
+
+    app.router.add_post('/bot{token}/{method}', handle_method)
+    return app
+
+
+async def start_stub_api(host: str = '127.0.0.1', port: int = 0, **kwargs):
+    """Запуск заглушки, возвращает (runner, base_url)"""
+    return await start_app(create_stub_api(**kwargs), host, port)
+
+
+async def start_stub_telegram(host: str = '127.0.0.1', port: int = 0, **kwargs):
+    """Запуск заглушки Telegram, возвращает (runner, base_url для Bot)"""
+    runner, base_url = await start_app(create_stub_telegram(**kwargs), host, port)
+    return runner, f'{base_url}/bot'
+
+
+async def start_app(app: web.Application, host: str, port: int):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://{host}:{port}'
+
+
+def percentile(values, p: float) -> float:
+    """Перцентиль по отсортированной выборке"""
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def serve(args):
+    api_latency = lognormal(args.latency, args.sigma) if args.sigma else args.latency
+    api_runner, api_url = await start_stub_api(
+        args.host, args.port,
+        latency=api_latency,
+        apartments=args.apartments,
+        domofons_per_apartment=args.domofons,
+        doors_per_domofon=args.doors,
+        snapshot_bytes=args.snapshot_bytes,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate
+    )
+    tg_runner, tg_url = await start_stub_telegram(
+        args.host, args.telegram_port,
+        latency=args.telegram_latency,
+        rate_limit_rate=args.telegram_rate_limit_rate
+    )
+    print(f'API домофонов: {api_url}')
+    print(f'Telegram: TELEGRAM_API_URL={tg_url}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api_runner.cleanup()
+        await tg_runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Симулятор API домофонов и Telegram')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--telegram-port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=0.05, help='медиана задержки API, с')
+    parser.add_argument('--sigma', type=float, default=0.0, help='логнормальный разброс задержки API')
+    parser.add_argument('--apartments', type=int, default=1)
+    parser.add_argument('--domofons', type=int, default=1, help='домофонов на квартиру')
+    parser.add_argument('--doors', type=int, default=1, help='дверей у домофона')
+    parser.add_argument('--snapshot-bytes', type=int, default=50_000)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.01)
+    parser.add_argument('--telegram-rate-limit-rate', type=float, default=0.0)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+"""Сквозной набор бенчмарков: обработчики DomophoneBot и webhook_server против
+локальных симуляторов API домофонов и Telegram.
+
+Результаты дописываются в benchmarks/results.jsonl с хэшем коммита; для каждого
+сценария печатается изменение относительно последнего прогона на другом коммите.
+
+Запуск: python -m benchmarks.suite [--total 200] [--scenarios bot_domofons,webhook_calls]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+# Лимиты Telegram измеряет bench_send_scheduler; здесь они не должны заслонять обработчики
+os.environ.setdefault('TELEGRAM_GLOBAL_RATE', '1000')
+os.environ.setdefault('TELEGRAM_GLOBAL_BURST', '100')
+os.environ.setdefault('TELEGRAM_TOKEN', '123:bench')
+os.environ.setdefault('DOMOPHONE_API_TOKEN', 'bench')
+
+from benchmarks.stub_api import lognormal, percentile, start_stub_api, start_stub_telegram
+
+RESULTS_PATH = os.path.join(os.path.dirname(__file__), 'results.jsonl')
+
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+
+def latency_metrics(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'throughput_rps': round(len(latencies) / elapsed, 1)
+    }
+
+
+async def drive(count: int, concurrency: int, make_call: Callable) -> Dict[str, float]:
+    """count вызовов make_call(i) не более чем по concurrency одновременно"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            await make_call(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return latency_metrics(latencies, time.perf_counter() - started)
+
+
+def chat_message(update_id: int, chat_id: int, **fields) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+            **fields
+        }
+    }
+
+
+def command(update_id: int, chat_id: int, text: str) -> dict:
+    return chat_message(
+        update_id, chat_id, text=text,
+        entities=[{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    )
+
+
+def button(update_id: int, chat_id: int, data: str) -> dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': 'bench',
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+            'data': data,
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}}
+        }
+    }
+
+
+class BotScenarios:
+    """Сценарии, которые прогоняют обновления через обработчики DomophoneBot"""
+
+    def __init__(self, api_url: str, total: int, concurrency: int):
+        import bot
+        from telegram import Update
+
+        bot.settings.API_URL = api_url
+        self.Update = Update
+        self.bot = bot.DomophoneBot()
+        self.app = self.bot.app
+        self.total = total
+        self.concurrency = concurrency
+        self.update_id = 0
+
+    async def start(self):
+        await self.app.initialize()
+        await self.bot.post_init(self.app)
+
+    async def stop(self):
+        await self.bot.post_shutdown(self.app)
+        await self.app.shutdown()
+
+    async def process(self, data: dict):
+        await self.app.process_update(self.Update.de_json(data, self.app.bot))
+
+    def next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def authorize(self, first_chat: int):
+        """Сессии для чатов first_chat..first_chat+total: у каждого свой жилец"""
+        for i in range(self.total):
+            self.bot.sessions.save(first_chat + i, first_chat + i, f'79{first_chat + i:09d}')
+        self.bot.sessions.flush()
+
+    async def bot_auth_contact(self) -> Dict[str, float]:
+        """Авторизация по контакту (с фоновой предзагрузкой)"""
+        return await drive(self.total, self.concurrency, lambda i: self.process(chat_message(
+            self.next_id(), 100000 + i,
+            contact={'phone_number': f'+79{100000 + i:09d}', 'first_name': 'Bench', 'user_id': 100000 + i}
+        )))
+
+    async def bot_domofons(self) -> Dict[str, float]:
+        """/domofons для жильцов без кэша"""
+        self.authorize(200000)
+        return await drive(self.total, self.concurrency, lambda i: self.process(
+            command(self.next_id(), 200000 + i, '/domofons')
+        ))
+
+    async def bot_open_door(self) -> Dict[str, float]:
+        """Нажатие "Открыть" до сообщения о результате"""
+        self.authorize(300000)
+        return await drive(self.total, self.concurrency, lambda i: self.process(
+            button(self.next_id(), 300000 + i, f'v1:open:{i % 50 + 1}')
+        ))
+
+    async def bot_snapshot(self) -> Dict[str, float]:
+        """Снимок с камеры: 20 камер на всех чатах"""
+        self.authorize(400000)
+        return await drive(self.total, self.concurrency, lambda i: self.process(
+            button(self.next_id(), 400000 + i, f'v1:snapshot:{i % 20 + 1}')
+        ))
+
+    async def bot_all_snapshots(self) -> Dict[str, float]:
+        """Снимки всех подъездов жильца одним альбомом"""
+        self.authorize(500000)
+        return await drive(self.total, self.concurrency, lambda i: self.process(
+            button(self.next_id(), 500000 + i, 'v1:snapshots')
+        ))
+
+
+async def webhook_calls(total: int, concurrency: int) -> Dict[str, float]:
+    """Прием вызовов webhook_server и доставка уведомлений со снимком"""
+    import webhook_server
+    from benchmarks.load_webhook import TENANTS, fire_calls
+
+    for tenant_id in range(1, TENANTS + 1):
+        webhook_server.session_store.save(100000 + tenant_id, tenant_id, f'7900{tenant_id:07d}')
+    webhook_server.session_store.flush()
+
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(webhook_server.app, host='127.0.0.1', port=0, log_level='warning'))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        latencies, statuses, elapsed = await fire_calls(f'http://127.0.0.1:{port}', total, concurrency)
+        drain_started = time.perf_counter()
+        while await asyncio.to_thread(webhook_server.notification_queue.depth):
+            await asyncio.sleep(0.05)
+        drain = time.perf_counter() - drain_started
+    finally:
+        server.should_exit = True
+        await server_task
+    metrics = latency_metrics(latencies, elapsed)
+    metrics['drain_ms'] = round(drain * 1000, 1)
+    metrics['accepted'] = statuses.get(202, 0)
+    return metrics
+
+
+BOT_SCENARIOS = ['bot_auth_contact', 'bot_domofons', 'bot_open_door', 'bot_snapshot', 'bot_all_snapshots']
+SCENARIOS = BOT_SCENARIOS + ['webhook_calls']
+
+
+def current_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', '*.py'], capture_output=True).returncode
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_results(path: str) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(record: dict, history: List[dict]) -> str:
+    """Изменение метрик относительно последнего прогона того же сценария на другом коммите"""
+    for previous in reversed(history):
+        if (
+            previous['scenario'] == record['scenario']
+            and previous['params'] == record['params']
+            and previous['commit'] != record['commit']
+        ):
+            changes = []
+            for key, value in record['metrics'].items():
+                old = previous['metrics'].get(key)
+                if old:
+                    changes.append(f'{key} {(value - old) / old * 100:+.1f}%')
+            return f"  vs {previous['commit']}: " + ', '.join(changes)
+    return '  нет прогона на другом коммите для сравнения'
+
+
+async def run(args) -> List[dict]:
+    api_latency = lognormal(args.latency, args.sigma) if args.sigma else args.latency
+    api_runner, api_url = await start_stub_api(
+        latency=api_latency,
+        apartments=args.apartments,
+        snapshot_bytes=args.snapshot_bytes,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate
+    )
+    tg_runner, tg_url = await start_stub_telegram(
+        latency=args.telegram_latency,
+        rate_limit_rate=args.telegram_rate_limit_rate
+    )
+    data_dir = tempfile.mkdtemp()
+    os.environ['TELEGRAM_API_URL'] = tg_url
+    os.environ['DOMOPHONE_API_URL'] = api_url
+    os.environ['DOMOPHONE_DB'] = os.path.join(data_dir, 'domophone.db')
+    os.environ['NOTIFY_QUEUE_DB'] = os.path.join(data_dir, 'notifications.db')
+    os.environ['EVENT_LOG_DB'] = os.path.join(data_dir, 'events.db')
+
+    scenarios = args.scenarios.split(',') if args.scenarios else SCENARIOS
+    results = {}
+    try:
+        if any(name in BOT_SCENARIOS for name in scenarios):
+            bot_scenarios = BotScenarios(api_url, args.total, args.concurrency)
+            await bot_scenarios.start()
+            try:
+                for name in scenarios:
+                    if name in BOT_SCENARIOS:
+                        results[name] = await getattr(bot_scenarios, name)()
+            finally:
+                await bot_scenarios.stop()
+        if 'webhook_calls' in scenarios:
+            results['webhook_calls'] = await webhook_calls(args.total, args.concurrency)
+    finally:
+        await api_runner.cleanup()
+        await tg_runner.cleanup()
+
+    params = {
+        key: getattr(args, key) for key in (
+            'total', 'concurrency', 'latency', 'sigma', 'apartments', 'snapshot_bytes',
+            'error_rate', 'rate_limit_rate', 'telegram_latency', 'telegram_rate_limit_rate'
+        )
+    }
+    commit = current_commit()
+    timestamp = time.time()
+    return [
+        {'commit': commit, 'timestamp': timestamp, 'scenario': name, 'params': params, 'metrics': metrics}
+        for name, metrics in results.items()
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сквозные бенчмарки бота и webhook_server')
+    parser.add_argument('--scenarios', help=f'через запятую из: {",".join(SCENARIOS)}')
+    parser.add_argument('--total', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05, help='медиана задержки API, с')
+    parser.add_argument('--sigma', type=float, default=0.5, help='логнормальный разброс задержки API')
+    parser.add_argument('--apartments', type=int, default=5)
+    parser.add_argument('--snapshot-bytes', type=int, default=500_000)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.02)
+    parser.add_argument('--telegram-rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--results', default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    history = load_results(args.results)
+    records = asyncio.run(run(args))
+    with open(args.results, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    for record in records:
+        print(f"{record['scenario']:<18} " + ' '.join(f'{k}={v}' for k, v in record['metrics'].items()))
+        print(compare(record, history))
+
+
+if __name__ == '__main__':
+    main()
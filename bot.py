@@ -1,13 +1,40 @@
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler
 from telegram.ext import ContextTypes, filters
+import asyncio
+import functools
 import httpx
 import logging
 import json
 import os
+import time
+from datetime import datetime
 from dotenv import load_dotenv
 from app.core.config import settings
 from fastapi import HTTPException
+from http_client import build_async_client, timeout_for
+from cache import TTLCache
+from send_scheduler import PRIORITY_CALL, PRIORITY_INFO, TELEGRAM_CALLS_RATE_SHARE, SendScheduler
+from snapshot_service import SnapshotService, photo_file_id
+from session_store import SessionStore
+from shared_cache import SharedCache
+from prefetch import Prefetcher
+from phones import normalize_phone
+from event_log import EVENT_CALL, EVENT_OPEN, EventLog
+from metrics import (
+    DOOR_OPEN_DUPLICATES, DOOR_OPEN_LATENCY, DOOR_OPEN_REPLY_LATENCY, METRICS_PORT,
+    observe_handler, register_stats, should_log_body
+)
+from bot_cluster import ChatOrderedProcessor
+from bulk_access import ACTION_GRANT, ACTION_REVOKE, AccessJournal, parse_access_rows, run_job
+from callbacks import (
+    ACTION_HISTORY, ACTION_OPEN, ACTION_SNAPSHOT, ACTION_SNAPSHOTS_ALL, encode_callback, parse_callback
+)
+from prometheus_client import start_http_server
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from api_client import ApiClient
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -22,17 +49,231 @@ logger = logging.getLogger(__name__)
 # Конфигурация
 API_URL = settings.BASE_URL
 TELEGRAM_TOKEN = settings.TELEGRAM_TOKEN
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+# Сколько запросов домофонов по квартирам выполняется одновременно
+DOMOFONS_FETCH_CONCURRENCY = int(os.getenv('DOMOFONS_FETCH_CONCURRENCY', '10'))
+# Кэш списка домофонов жильца
+DOMOFONS_CACHE_TTL = float(os.getenv('DOMOFONS_CACHE_TTL', '300'))
+DOMOFONS_CACHE_MAX_ENTRIES = int(os.getenv('DOMOFONS_CACHE_MAX_ENTRIES', '10000'))
+DOMOFONS_CACHE_MAX_BYTES = int(os.getenv('DOMOFONS_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Локальная копия живет меньше, чтобы сброс в общем кэше быстро дошел до всех процессов
+DOMOFONS_LOCAL_CACHE_TTL = min(DOMOFONS_CACHE_TTL, float(os.getenv('DOMOFONS_LOCAL_CACHE_TTL', '30')))
+# Для скольких домофонов жильца заранее получаются URL снимков после авторизации
+PREFETCH_SNAPSHOT_URLS = int(os.getenv('PREFETCH_SNAPSHOT_URLS', '10'))
+# Повторные нажатия "Открыть" на ту же дверь в пределах окна не отправляются в API
+OPEN_DEDUPE_WINDOW = float(os.getenv('OPEN_DEDUPE_WINDOW', '3'))
+# Сколько событий показывает одна страница /history
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '10'))
+# Режим получения обновлений: webhook (через webhook_server) или polling
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+BOT_WEBHOOK_URL = os.getenv('BOT_WEBHOOK_URL')
+BOT_WEBHOOK_SECRET = os.getenv('BOT_WEBHOOK_SECRET')
+# Сколько обновлений разных чатов обрабатывается одновременно в режиме webhook;
+# при polling обновления обрабатываются по одному
+BOT_CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', '64'))
+# Ограничение Telegram на число фото в одном альбоме
+MEDIA_GROUP_MAX_PHOTOS = 10
 
 # Нужно добавить обработку ошибок при отсутствии TELEGRAM_TOKEN
 if not TELEGRAM_TOKEN:
     raise ValueError("Не задан TELEGRAM_TOKEN в .env файле")
 
+
+@functools.lru_cache(maxsize=10000)
+def open_request_template(tenant_id, domofon_id: int, door_id: int) -> Tuple[str, tuple, bytes]:
+    """URL, параметры и тело запроса открытия двери, собранные один раз на жильца и дверь"""
+    return (
+        f"{settings.API_URL}/domo.domofon/{domofon_id}/open",
+        (("tenant_id", tenant_id),),
+        json.dumps({"door_id": door_id}).encode()
+    )
+
+
+def check_webhook_secret():
+    """Без секрета любой, кто достучится до webhook_server, сможет прислать поддельное обновление"""
+    if not BOT_WEBHOOK_SECRET:
+        raise ValueError("Не задан BOT_WEBHOOK_SECRET: без него режим webhook не запускается")
+
+
+def domofon_address(domofon: dict) -> str:
+    """Адрес домофона с подъездом для кнопок и подписей"""
+    location = domofon.get('location', {})
+    address = location.get('readable_address', 'Адрес не указан')
+    porch = location.get('porch', '')
+    return f"{address} (подъезд {porch})" if porch else address
+
+
+def domofon_doors(domofon: dict) -> List[Tuple[int, Optional[str]]]:
+    """Двери домофона: id и название. Если API не вернул список дверей - одна дверь 1"""
+    doors = []
+    for door in domofon.get('doors') or ():
+        if isinstance(door, dict):
+            door_id, name = door.get('id', door.get('door_id')), door.get('name')
+        else:
+            door_id, name = door, None
+        if door_id is not None:
+            doors.append((int(door_id), name))
+    return doors or [(1, None)]
+
+
 class DomophoneBot:
-    def __init__(self):
+    def __init__(self, api_client: Optional['ApiClient'] = None, scheduler: Optional[SendScheduler] = None):
         if not TELEGRAM_TOKEN:
             raise ValueError("Не задан TELEGRAM_TOKEN")
-        self.app = Application.builder().token(TELEGRAM_TOKEN).build()
+        self.http: httpx.AsyncClient = None
+        # В одном процессе с webhook_server бот отправляет через его планировщик, иначе
+        # уведомления о вызовах шлет другой процесс и общий лимит бота делится с ним
+        self._own_scheduler = scheduler is None
+        if scheduler is None:
+            scheduler = SendScheduler()
+            scheduler.scale_global_rate(1 - TELEGRAM_CALLS_RATE_SHARE)
+        self.scheduler = scheduler
+        self.snapshots = SnapshotService()
+        self.domofons_cache = TTLCache(
+            ttl=DOMOFONS_LOCAL_CACHE_TTL,
+            max_entries=DOMOFONS_CACHE_MAX_ENTRIES,
+            max_bytes=DOMOFONS_CACHE_MAX_BYTES
+        )
+        self.sessions = SessionStore()
+        self.shared_cache = SharedCache()
+        self.prefetcher = Prefetcher()
+        self._recent_opens: Dict[tuple, float] = {}
+        self._stale_phones = set()
+        self._invalidation: Optional[asyncio.Task] = None
+        self.events = EventLog()
+        self.access_journal = AccessJournal()
+        self.access_client = None
+        self.updates: Optional[ChatOrderedProcessor] = None
+        if api_client is not None:
+            api_client.add_access_listener(self.invalidate_phone)
+        self.headers = {
+            "x-api-key": settings.API_TOKEN,
+            "Content-Type": "application/json"
+        }
+        self.app = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .base_url(TELEGRAM_API_URL)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
         self.setup_handlers()
+
+    async def post_init(self, application: Application):
+        """Создание общего HTTP-клиента при старте приложения"""
+        self.http = build_async_client(headers=self.headers)
+        self.scheduler.start()
+        self.sessions.start()
+        self.events.start()
+        register_stats('domophone_domofons_cache', 'Кэш списков домофонов', self.domofons_cache.stats)
+        register_stats('domophone_bot_snapshot_cache', 'Кэш снимков с камер в боте', self.snapshots.images.stats)
+        if self._own_scheduler:
+            register_stats('domophone_bot_send_scheduler', 'Очередь отправок в Telegram из бота', self.scheduler.stats)
+        register_stats('domophone_prefetch', 'Задачи предзагрузки', self.prefetcher.stats)
+        register_stats('domophone_phone_index', 'Индекс телефонов в памяти', self.sessions.phones.stats)
+        if METRICS_PORT:
+            start_http_server(METRICS_PORT)
+
+    async def post_shutdown(self, application: Application):
+        """Закрытие HTTP-клиента при остановке приложения"""
+        await self.prefetcher.stop()
+        if self._invalidation is not None:
+            await asyncio.gather(self._invalidation, return_exceptions=True)
+        if self._own_scheduler:
+            await self.scheduler.stop()
+        await self.sessions.stop()
+        await self.events.stop()
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
+        if self.access_client is not None:
+            await self.access_client.close()
+            self.access_client = None
+
+    async def reply(self, send, *args, priority: int = PRIORITY_INFO, **kwargs):
+        """Ответ в чат через общий планировщик отправок с учетом лимитов Telegram"""
+        chat_id = send.__self__.chat_id
+        return await self.scheduler.send(
+            chat_id, lambda: send(*args, **kwargs), priority=priority
+        )
+
+    def invalidate_phone(self, phone: str):
+        """Сброс кэша домофонов пользователя после выдачи или отзыва доступа.
+        Вызывается на каждую строку массового задания, поэтому запросы к SQLite
+        выполняются в фоне одной пачкой, а не в цикле событий"""
+        tenant_id = self.sessions.phones.tenant_for(phone)
+        if tenant_id is not None:
+            self.domofons_cache.invalidate(tenant_id)
+        self._stale_phones.add(phone)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Синхронный клиент API вне цикла событий: сброс сразу
+            phones, self._stale_phones = self._stale_phones, set()
+            for tenant_id in self._invalidate_shared(phones):
+                self.domofons_cache.invalidate(tenant_id)
+            return
+        if self._invalidation is None or self._invalidation.done():
+            self._invalidation = loop.create_task(self._invalidate_stale())
+
+    async def _invalidate_stale(self):
+        while self._stale_phones:
+            phones, self._stale_phones = self._stale_phones, set()
+            try:
+                tenants = await asyncio.to_thread(self._invalidate_shared, phones)
+            except Exception as e:
+                logger.error(f"Ошибка сброса общего кэша домофонов: {e}")
+                continue
+            # Жильцы, которых не было в индексе телефонов, найдены только сейчас
+            for tenant_id in tenants:
+                self.domofons_cache.invalidate(tenant_id)
+
+    def _invalidate_shared(self, phones) -> set:
+        """Сброс общего кэша домофонов жильцов с этими телефонами"""
+        tenants = {self.sessions.tenant_for_phone(phone) for phone in phones}
+        tenants.discard(None)
+        if tenants:
+            self.shared_cache.invalidate_many(f"domofons:{tenant_id}" for tenant_id in tenants)
+        return tenants
+
+    async def get_tenant_id(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """tenant_id пользователя: из user_data или из сохраненной сессии"""
+        tenant_id = context.user_data.get('tenant_id')
+        if tenant_id is None:
+            session = await self.sessions.get(update.effective_chat.id)
+            if session is not None:
+                tenant_id = context.user_data['tenant_id'] = session['tenant_id']
+                self.prefetch(update.effective_chat.id, tenant_id)
+        return tenant_id
+
+    def prefetch(self, chat_id: int, tenant_id):
+        """Фоновая загрузка данных, которые понадобятся следующим нажатиям пользователя"""
+        self.prefetcher.schedule(chat_id, lambda: self.warm_tenant(tenant_id))
+
+    async def warm_tenant(self, tenant_id):
+        """Загрузка в кэш домофонов жильца и URL снимков их камер"""
+        warm = tenant_id in self.domofons_cache
+        domofons = await self.domofons_cache.get_or_load(
+            tenant_id, lambda: self.load_domofons(tenant_id)
+        )
+        if not warm:
+            self.prefetcher.mark('domofons', tenant_id)
+
+        domofon_ids = [
+            int(domofon['id']) for domofon in domofons[:PREFETCH_SNAPSHOT_URLS]
+            if int(domofon['id']) not in self.snapshots.urls
+        ]
+        if not domofon_ids:
+            return
+        urls = await self.fetch_snapshot_urls(tenant_id, domofon_ids)
+        for domofon_id, url in urls.items():
+            self.snapshots.urls.set(domofon_id, url)
+            self.prefetcher.mark('snapshot_url', domofon_id)
+
+    def cache_stats(self) -> dict:
+        """Счетчики кэша домофонов"""
+        return self.domofons_cache.stats()
         
     def setup_handlers(self):
         """Настройка обработчиков команд"""
@@ -40,13 +281,25 @@ class DomophoneBot:
         self.app.add_handler(CommandHandler("help", self.help_command))
         self.app.add_handler(MessageHandler(filters.CONTACT, self.handle_contact))
         self.app.add_handler(CommandHandler("domofons", self.show_domofons))
+        self.app.add_handler(CommandHandler("history", self.history_command))
+        self.app.add_handler(CommandHandler([ACTION_GRANT, ACTION_REVOKE], self.bulk_access_command))
+        self.app.add_handler(MessageHandler(
+            filters.Document.ALL & filters.CaptionRegex(r'^/(grant|revoke)\b'), self.bulk_access_command
+        ))
         self.app.add_handler(CallbackQueryHandler(self.handle_callback))
+        self.callback_actions = {
+            ACTION_OPEN: self.open_door,
+            ACTION_SNAPSHOT: self.send_snapshot,
+            ACTION_SNAPSHOTS_ALL: self.send_all_snapshots,
+            ACTION_HISTORY: self.show_history
+        }
         
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /start"""
         keyboard = [[{"text": "Отправить номер телефона", "request_contact": True}]]
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
-        await update.message.reply_text(
+        await self.reply(
+            update.message.reply_text,
             "Добро пожаловать! Для начала работы, пожалуйста, поделитесь номером телефона.",
             reply_markup=reply_markup
         )
@@ -59,235 +312,593 @@ class DomophoneBot:
 /start - Начать работу с ботом
 /help - Показать эту справку
 /domofons - Показать список доступных домофонов
+/history - История вызовов и открытий дверей
+/grant, /revoke - Массовая выдача и отзыв доступа (для суперпользователей)
 
 *Возможности:*
 • 📱 Авторизация по номеру телефона
 • 📋 Просмотр списка доступных домофонов
-• 📷 Получение снимков с камер
+• 📷 Получение снимков с камер, в том числе всех подъездов одним альбомом
 • 🚪 Открытие дверей
 • 🔔 Уведомления о входящих вызовах
+• 📜 История вызовов и открытий дверей
 
 *Как пользоваться:*
 1. Отправьте свой номер телефона для авторизации
 2. Используйте команду /domofons для просмотра списка
 3. Нажимайте на кнопки для получения снимков и открытия дверей
         """
-        await update.message.reply_text(
+        await self.reply(
+            update.message.reply_text,
             help_text,
             parse_mode='Markdown'
         )
 
+    @observe_handler('handle_contact')
     async def handle_contact(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка полученного контакта"""
+        contact = update.message.contact
+        # Чужая карточка контакта не дает права получать вызовы и открывать двери
+        if contact.user_id != update.effective_user.id:
+            await self.reply(
+                update.message.reply_text,
+                "❌ Отправьте свой номер кнопкой «Отправить номер телефона»."
+            )
+            return
         try:
-            phone = update.message.contact.phone_number
-            if not phone.startswith('+'):
-                phone = '+' + phone
-            
-            # Преобразуем телефон в формат 7XXXXXXXXXX
-            phone = phone.replace('+', '')
-            if phone.startswith('8'):
-                phone = '7' + phone[1:]
+            phone = normalize_phone(contact.phone_number)
+            if phone is None:
+                raise ValueError(f"неверный номер {contact.phone_number}")
             
             logger.info(f"Получен номер телефона: {phone}")
             
-            # Получаем tenant_id по номеру телефона
-            headers = {
-                "x-api-key": settings.API_TOKEN,
-                "Content-Type": "application/json"
-            }
-            
-            # Используем правильный эндпоинт из документации
-            url = f"{settings.API_URL}/check-tenant"
-            payload = {"phone": int(phone)}
-            
-            logger.info(f"Отправляем запрос: URL={url}, payload={payload}")
+            # Уже известный телефон авторизуется по индексу в памяти, без запроса к API
+            tenant_id = self.sessions.phones.tenant_for(phone)
+            if tenant_id is None:
+                tenant_id = await self.check_tenant(phone)
+            if tenant_id is None:
+                await self.reply(update.message.reply_text, "❌ Номер не найден среди жильцов.")
+                return
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    url,
-                    headers=headers,
-                    json=payload
-                )
-                
-                logger.info(f"Статус ответа: {response.status_code}")
-                logger.info(f"Тело ответа: {response.text}")
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    tenant_id = data.get('tenant_id')  # Получаем tenant_id из ответа
-                    context.user_data['tenant_id'] = tenant_id
-                    await update.message.reply_text(
-                        "✅ Авторизация успешна! Используйте /domofons для просмотра доступных домофонов."
-                    )
-                else:
-                    raise HTTPException(status_code=response.status_code, detail=response.text)
+            context.user_data['tenant_id'] = tenant_id
+            self.sessions.save(update.effective_chat.id, tenant_id, phone)
+            self.prefetch(update.effective_chat.id, tenant_id)
+            await self.reply(
+                update.message.reply_text,
+                "✅ Авторизация успешна! Используйте /domofons для просмотра доступных домофонов."
+            )
 
         except Exception as e:
             logger.error(f"Ошибка при обработке контакта: {str(e)}")
-            await update.message.reply_text(
+            await self.reply(
+                update.message.reply_text,
                 "❌ Ошибка авторизации. Попробуйте позже или обратитесь в поддержку."
             )
 
+    async def check_tenant(self, phone: str):
+        """tenant_id жильца по телефону через API"""
+        # Используем правильный эндпоинт из документации
+        url = f"{settings.API_URL}/check-tenant"
+        payload = {"phone": int(phone)}
+        
+        logger.info(f"Отправляем запрос: URL={url}, payload={payload}")
+        
+        response = await self.http.post(
+            url,
+            json=payload,
+            timeout=timeout_for('check-tenant')
+        )
+        
+        logger.info(f"Статус ответа: {response.status_code}")
+        if should_log_body():
+            logger.info(f"Тело ответа: {response.text}")
+        
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+        return response.json().get('tenant_id')
+
+    async def fetch_apartment_domofons(self, tenant_id, apartment_id, semaphore: asyncio.Semaphore) -> list:
+        """Получение домофонов одной квартиры"""
+        domofons_url = f"{settings.API_URL}/domo.apartment/{apartment_id}/domofon"
+        domofons_params = {"tenant_id": tenant_id}
+        
+        async with semaphore:
+            domofons_response = await self.http.get(
+                domofons_url,
+                params=domofons_params,
+                timeout=timeout_for('domofon')
+            )
+        
+        if domofons_response.status_code != 200:
+            return []
+        return domofons_response.json()
+
+    async def fetch_domofons(self, tenant_id) -> list:
+        """Получение всех домофонов жильца по всем его квартирам"""
+        # 1. Получаем список квартир
+        apartments_url = f"{settings.API_URL}/domo.apartment"
+        params = {"tenant_id": tenant_id}
+        
+        logger.info(f"Запрос списка квартир: URL={apartments_url}, params={params}")
+        
+        apartments_response = await self.http.get(
+            apartments_url,
+            params=params,
+            timeout=timeout_for('domo.apartment')
+        )
+        
+        if apartments_response.status_code != 200:
+            raise HTTPException(status_code=apartments_response.status_code, 
+                             detail=apartments_response.text)
+            
+        apartments = apartments_response.json()
+        
+        # 2. Для всех квартир получаем домофоны параллельно; gather сохраняет
+        # порядок квартир, поэтому клавиатура остается детерминированной
+        semaphore = asyncio.Semaphore(DOMOFONS_FETCH_CONCURRENCY)
+        results = await asyncio.gather(*(
+            self.fetch_apartment_domofons(tenant_id, apartment['id'], semaphore)
+            for apartment in apartments
+        ))
+        return [domofon for domofons in results for domofon in domofons]
+
+    async def load_domofons(self, tenant_id) -> list:
+        """Домофоны жильца из общего кэша процессов или из API"""
+        key = f"domofons:{tenant_id}"
+        domofons = await asyncio.to_thread(self.shared_cache.get, key)
+        if domofons is None:
+            domofons = await self.fetch_domofons(tenant_id)
+            await asyncio.to_thread(self.shared_cache.set, key, domofons, DOMOFONS_CACHE_TTL)
+        return domofons
+
+    @observe_handler('show_domofons')
     async def show_domofons(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показ списка доступных домофонов"""
-        if 'tenant_id' not in context.user_data:
-            await update.message.reply_text(
+        tenant_id = await self.get_tenant_id(update, context)
+        if tenant_id is None:
+            await self.reply(
+                update.message.reply_text,
                 "Вы не авторизованы. Используйте /start для авторизации."
             )
             return
             
         try:
-            headers = {
-                "x-api-key": settings.API_TOKEN,
-                "Content-Type": "application/json"
-            }
-            
-            # 1. Получаем список квартир
-            apartments_url = f"{settings.API_URL}/domo.apartment"
-            params = {"tenant_id": context.user_data['tenant_id']}
-            
-            logger.info(f"Запрос списка квартир: URL={apartments_url}, params={params}")
+            self.prefetcher.record('domofons', tenant_id, tenant_id in self.domofons_cache)
+            domofons = await self.domofons_cache.get_or_load(
+                tenant_id, lambda: self.load_domofons(tenant_id)
+            )
+            keyboard = []
             
-            async with httpx.AsyncClient() as client:
-                apartments_response = await client.get(
-                    apartments_url,
-                    headers=headers,
-                    params=params
+            for domofon in domofons:
+                snapshot_button = InlineKeyboardButton(
+                    f"📷 {domofon_address(domofon)}",
+                    callback_data=encode_callback(ACTION_SNAPSHOT, domofon['id'])
                 )
-                
-                if apartments_response.status_code != 200:
-                    raise HTTPException(status_code=apartments_response.status_code, 
-                                     detail=apartments_response.text)
-                    
-                apartments = apartments_response.json()
-                keyboard = []
-                
-                # 2. Для каждой квартиры получаем домофоны
-                for apartment in apartments:
-                    domofons_url = f"{settings.API_URL}/domo.apartment/{apartment['id']}/domofon"
-                    domofons_params = {"tenant_id": context.user_data['tenant_id']}
-                    
-                    domofons_response = await client.get(
-                        domofons_url,
-                        headers=headers,
-                        params=domofons_params
+                doors = domofon_doors(domofon)
+                if len(doors) == 1:
+                    keyboard.append([
+                        snapshot_button,
+                        InlineKeyboardButton(
+                            "🚪 Открыть",
+                            callback_data=encode_callback(ACTION_OPEN, domofon['id'], doors[0][0])
+                        )
+                    ])
+                    continue
+                # Несколько дверей: под строкой снимка по кнопке на каждую дверь
+                keyboard.append([snapshot_button])
+                door_buttons = [
+                    InlineKeyboardButton(
+                        f"🚪 {name or f'Дверь {door_id}'}",
+                        callback_data=encode_callback(ACTION_OPEN, domofon['id'], door_id)
                     )
-                    
-                    if domofons_response.status_code != 200:
-                        continue
-                        
-                    domofons = domofons_response.json()
-                    
-                    for domofon in domofons:
-                        location = domofon.get('location', {})
-                        address = location.get('readable_address', 'Адрес не указан')
-                        porch = location.get('porch', '')
-                        address_text = f"{address} (подъезд {porch})" if porch else address
-                        
-                        keyboard.append([
-                            InlineKeyboardButton(
-                                f"📷 {address_text}",
-                                callback_data=f"snapshot_{domofon['id']}"
-                            ),
-                            InlineKeyboardButton(
-                                f"🚪 Открыть",
-                                callback_data=f"open_{domofon['id']}"
-                            )
-                        ])
+                    for door_id, name in doors
+                ]
+                for start in range(0, len(door_buttons), 4):
+                    keyboard.append(door_buttons[start:start + 4])
+
+            if len(domofons) > 1:
+                keyboard.append([InlineKeyboardButton(
+                    "📷 Снимки всех подъездов",
+                    callback_data=encode_callback(ACTION_SNAPSHOTS_ALL)
+                )])
+            
+            if keyboard:
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                await self.reply(
+                    update.message.reply_text,
+                    "Выберите действие:",
+                    reply_markup=reply_markup
+                )
+            else:
+                await self.reply(update.message.reply_text, "У вас нет доступных домофонов")
                 
-                if keyboard:
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await update.message.reply_text(
-                        "Выберите действие:",
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await update.message.reply_text("У вас нет доступных домофонов")
-                    
         except Exception as e:
             logger.error(f"Ошибка получения списка домофонов: {str(e)}")
-            await update.message.reply_text(
+            await self.reply(
+                update.message.reply_text,
                 "❌ Ошибка получения списка домофонов. Попробуйте позже."
             )
 
+    async def fetch_snapshot_urls(self, tenant_id, domofon_ids: List[int]) -> Dict[int, str]:
+        """URL снимков нескольких камер одним запросом"""
+        url = f"{settings.API_URL}/domo.domofon/urlsOnType"
+        payload = {
+            "intercoms_id": [int(domofon_id) for domofon_id in domofon_ids],
+            "media_type": ["JPEG"]
+        }
+        params = {"tenant_id": tenant_id}
+        
+        response = await self.http.post(
+            url,
+            json=payload,
+            params=params,
+            timeout=timeout_for('urlsOnType')
+        )
+        
+        if response.status_code != 200:
+            return {}
+        requested = set(payload["intercoms_id"])
+        urls = {}
+        # URL кэшируется, поэтому сопоставляется только по id: элемент без id или
+        # с чужим id отбрасывается, а не привязывается к камере по порядку
+        for item in response.json():
+            try:
+                domofon_id = int(item.get('id'))
+            except (TypeError, ValueError):
+                continue
+            if domofon_id in requested and item.get('jpeg'):
+                urls[domofon_id] = item['jpeg']
+        return urls
+
+    async def fetch_snapshot_url(self, tenant_id, domofon_id) -> Optional[str]:
+        """Получение URL снимка камеры домофона"""
+        urls = await self.fetch_snapshot_urls(tenant_id, [int(domofon_id)])
+        return urls.get(int(domofon_id))
+
+    @observe_handler('handle_callback')
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка нажатий на кнопки"""
+        received_at = time.perf_counter()
         query = update.callback_query
-        action, domofon_id = query.data.split('_')
-        
+        callback = parse_callback(query.data)
+        action = self.callback_actions.get(callback.action) if callback is not None else None
+        if action is None:
+            logger.warning(f"Неизвестная кнопка: {query.data}")
+            await self.answer_callback(query)
+            return
+
         try:
-            headers = {
-                "x-api-key": settings.API_TOKEN,
-                "Content-Type": "application/json"
-            }
-            
-            if action == "snapshot":
-                # Получаем снимок с камеры
-                url = f"{settings.API_URL}/domo.domofon/urlsOnType"
-                payload = {
-                    "intercoms_id": [int(domofon_id)],
-                    "media_type": ["JPEG"]
-                }
-                params = {"tenant_id": context.user_data['tenant_id']}
-                
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        url,
-                        headers=headers,
-                        json=payload,
-                        params=params
-                    )
-                    
-                    if response.status_code == 200:
-                        urls = response.json()
-                        if urls and urls[0].get('jpeg'):
-                            await query.message.reply_photo(
-                                urls[0]['jpeg'],
-                                caption="📷 Снимок с камеры"
-                            )
-                        else:
-                            await query.message.reply_text("❌ Не удалось получить снимок")
-                            
-            elif action == "open":
-                # Открываем дверь
-                url = f"{settings.API_URL}/domo.domofon/{domofon_id}/open"
-                payload = {"door_id": 1}
-                params = {"tenant_id": context.user_data['tenant_id']}
-                
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        url,
-                        headers=headers,
-                        json=payload,
-                        params=params
-                    )
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        await query.message.reply_text(data.get('msg', '✅ Дверь открыта'))
-                    else:
-                        await query.message.reply_text("❌ Не удалось открыть дверь")
-                        
+            await action(update, context, callback.args, received_at)
         except Exception as e:
             logger.error(f"Ошибка при обработке действия: {str(e)}")
-            await query.message.reply_text(f"❌ Ошибка: {str(e)}")
-        
-        await query.answer()
+            await self.reply(query.message.reply_text, f"❌ Ошибка: {str(e)}")
+
+    async def answer_callback(self, query, text: Optional[str] = None):
+        """Ответ на нажатие кнопки; ошибка ответа не должна мешать самому действию"""
+        try:
+            await query.answer(text)
+        except Exception as e:
+            logger.warning(f"Не удалось ответить на нажатие кнопки: {e}")
+
+    async def callback_tenant_id(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """tenant_id для нажатия кнопки или None с сообщением о необходимости авторизации"""
+        tenant_id = await self.get_tenant_id(update, context)
+        if tenant_id is None:
+            await self.reply(
+                update.callback_query.message.reply_text,
+                "Вы не авторизованы. Используйте /start для авторизации."
+            )
+        return tenant_id
+
+    async def send_snapshot(self, update: Update, context: ContextTypes.DEFAULT_TYPE, args, received_at: float):
+        """Снимок с камеры домофона"""
+        query = update.callback_query
+        answer = asyncio.create_task(self.answer_callback(query))
+        try:
+            tenant_id = await self.callback_tenant_id(update, context)
+            if tenant_id is None:
+                return
+            domofon_id = int(args[0])
+            self.prefetcher.record('snapshot_url', domofon_id, domofon_id in self.snapshots.urls)
+            if not await self.can_view_camera(tenant_id, domofon_id):
+                await self.reply(query.message.reply_text, "❌ Снимок с этой камеры недоступен")
+                return
+            message = await self.snapshots.send_photo(
+                domofon_id,
+                lambda: self.snapshots.get_url(
+                    domofon_id, lambda: self.fetch_snapshot_url(tenant_id, domofon_id)
+                ),
+                lambda photo: self.reply(
+                    query.message.reply_photo,
+                    photo,
+                    caption="📷 Снимок с камеры"
+                )
+            )
+            if message is None:
+                await self.reply(query.message.reply_text, "❌ Не удалось получить снимок")
+        finally:
+            await answer
+
+    async def can_view_camera(self, tenant_id, domofon_id: int) -> bool:
+        """Доступ жильца к камере. URL и file_id снимков общие для всех жильцов, а данные
+        кнопки присылает клиент, поэтому камера проверяется по списку домофонов жильца.
+        Если списка нет в кэше, проверку выполняет API: URL выдается по tenant_id жильца"""
+        domofons = self.domofons_cache.get(tenant_id)
+        if domofons is not None:
+            return any(int(domofon['id']) == domofon_id for domofon in domofons)
+        url = await self.fetch_snapshot_url(tenant_id, domofon_id)
+        if url is None:
+            return False
+        self.snapshots.urls.set(domofon_id, url)
+        return True
+
+    async def send_all_snapshots(self, update: Update, context: ContextTypes.DEFAULT_TYPE, args, received_at: float):
+        """Снимки всех камер жильца: недостающие URL одним запросом urlsOnType,
+        отправка альбомами до MEDIA_GROUP_MAX_PHOTOS фото"""
+        query = update.callback_query
+        answer = asyncio.create_task(self.answer_callback(query))
+        try:
+            tenant_id = await self.callback_tenant_id(update, context)
+            if tenant_id is None:
+                return
+            domofons = await self.domofons_cache.get_or_load(
+                tenant_id, lambda: self.load_domofons(tenant_id)
+            )
+            photos = await self.snapshot_photos(tenant_id, domofons)
+            if not photos:
+                await self.reply(query.message.reply_text, "❌ Не удалось получить снимки")
+                return
+            for start in range(0, len(photos), MEDIA_GROUP_MAX_PHOTOS):
+                await self.send_album(query.message, photos[start:start + MEDIA_GROUP_MAX_PHOTOS])
+        finally:
+            await answer
+
+    async def snapshot_photos(self, tenant_id, domofons: list) -> List[Tuple[int, str, bool, str]]:
+        """(domofon_id, фото, это file_id, подпись) для каждой камеры: file_id уже
+        загруженного снимка или URL; URL не из кэша запрашиваются одним запросом"""
+        photos = []
+        missing = []
+        for domofon in domofons:
+            domofon_id = int(domofon['id'])
+            file_id = self.snapshots.file_ids.get(domofon_id)
+            url = self.snapshots.urls.get(domofon_id) if file_id is None else None
+            if file_id is None and url is None:
+                missing.append(domofon_id)
+            photos.append((domofon_id, file_id or url, file_id is not None, domofon_address(domofon)))
+        if missing:
+            urls = await self.fetch_snapshot_urls(tenant_id, missing)
+            for domofon_id, url in urls.items():
+                self.snapshots.urls.set(domofon_id, url)
+            photos = [
+                (domofon_id, photo or urls.get(domofon_id), is_file_id, caption)
+                for domofon_id, photo, is_file_id, caption in photos
+            ]
+        return [photo for photo in photos if photo[1] is not None]
+
+    async def send_album(self, message, photos: List[Tuple[int, str, bool, str]]):
+        """Отправка снимков одним альбомом; file_id загруженных фото запоминаются для повторной отправки"""
+        if len(photos) == 1:
+            # Альбом в Telegram не может состоять из одного фото
+            _, photo, _, caption = photos[0]
+            sent = [await self.reply(message.reply_photo, photo, caption=f"📷 {caption}")]
+        else:
+            sent = await self.reply(
+                message.reply_media_group,
+                [InputMediaPhoto(photo, caption=f"📷 {caption}") for _, photo, _, caption in photos]
+            )
+        for (domofon_id, _, is_file_id, _), sent_message in zip(photos, sent):
+            file_id = photo_file_id(sent_message)
+            if not is_file_id and file_id is not None:
+                self.snapshots.file_ids.set(domofon_id, file_id)
+
+    async def open_door(self, update: Update, context: ContextTypes.DEFAULT_TYPE, args, received_at: float):
+        """Открытие двери: ответ на нажатие уходит сразу, повторные нажатия
+        на ту же дверь в пределах OPEN_DEDUPE_WINDOW не отправляются в API"""
+        query = update.callback_query
+        domofon_id = int(args[0])
+        door_id = int(args[1]) if len(args) > 1 else 1
+        key = (update.effective_chat.id, domofon_id, door_id)
+        now = time.monotonic()
+        if now - self._recent_opens.get(key, float('-inf')) < OPEN_DEDUPE_WINDOW:
+            DOOR_OPEN_DUPLICATES.inc()
+            await self.answer_callback(query, "⏳ Дверь уже открывается")
+            return
+        self._recent_opens[key] = now
+        self._prune_recent_opens(now)
+
+        answer = asyncio.create_task(self.answer_callback(query))
+        status = 'error'
+        try:
+            tenant_id = await self.callback_tenant_id(update, context)
+            if tenant_id is None:
+                return
+            url, params, content = open_request_template(tenant_id, domofon_id, door_id)
+            try:
+                response = await self.http.post(
+                    url,
+                    content=content,
+                    params=params,
+                    timeout=timeout_for('open')
+                )
+                status = 'ok' if response.status_code == 200 else 'failed'
+            finally:
+                DOOR_OPEN_LATENCY.labels(status).observe(time.perf_counter() - received_at)
+                self.events.append(
+                    EVENT_OPEN, tenant_id, domofon_id,
+                    chat_id=update.effective_chat.id, door_id=door_id, status=status
+                )
+
+            if status == 'ok':
+                data = response.json()
+                text = data.get('msg', '✅ Дверь открыта')
+            else:
+                text = "❌ Не удалось открыть дверь"
+            await self.reply(query.message.reply_text, text, priority=PRIORITY_CALL)
+            DOOR_OPEN_REPLY_LATENCY.labels(status).observe(time.perf_counter() - received_at)
+        finally:
+            if status != 'ok':
+                # После неудачи пользователь может сразу нажать еще раз
+                self._recent_opens.pop(key, None)
+            await answer
+
+    @observe_handler('history_command')
+    async def history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /history: последние вызовы и открытия дверей жильца"""
+        tenant_id = await self.get_tenant_id(update, context)
+        if tenant_id is None:
+            await self.reply(
+                update.message.reply_text,
+                "Вы не авторизованы. Используйте /start для авторизации."
+            )
+            return
+        text, reply_markup = await self.history_page(tenant_id)
+        await self.reply(update.message.reply_text, text, reply_markup=reply_markup)
+
+    async def show_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE, args, received_at: float):
+        """Кнопка "Ранее": следующая страница истории с позиции курсора (ts, id)"""
+        query = update.callback_query
+        answer = asyncio.create_task(self.answer_callback(query))
+        try:
+            tenant_id = await self.callback_tenant_id(update, context)
+            if tenant_id is None:
+                return
+            text, reply_markup = await self.history_page(tenant_id, (float(args[0]), int(args[1])))
+            await self.reply(query.message.edit_text, text, reply_markup=reply_markup)
+        finally:
+            await answer
+
+    async def history_page(self, tenant_id, before: Optional[Tuple[float, int]] = None):
+        """Текст страницы истории и кнопка перехода к более ранним событиям"""
+        events, next_cursor = await asyncio.to_thread(
+            self.events.tenant_history, tenant_id, HISTORY_PAGE_SIZE, before
+        )
+        if not events:
+            return ("История пуста" if before is None else "Более ранних событий нет"), None
+        lines = ["📜 История событий:"]
+        for event in events:
+            moment = f"{datetime.fromtimestamp(event['ts']):%d.%m %H:%M}"
+            if event['kind'] == EVENT_CALL:
+                description = "🔔 Вызов"
+            elif event['status'] == 'ok':
+                description = "🚪 Дверь открыта"
+            else:
+                description = "❌ Дверь не открылась"
+            door = f", дверь {event['door_id']}" if event['door_id'] not in (None, 1) else ""
+            lines.append(f"{moment} {description}, домофон {event['domofon_id']}{door}")
+        reply_markup = None
+        if next_cursor is not None:
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
+                "⬅️ Ранее", callback_data=encode_callback(ACTION_HISTORY, repr(next_cursor[0]), next_cursor[1])
+            )]])
+        return "\n".join(lines), reply_markup
+
+    def _prune_recent_opens(self, now: float):
+        if len(self._recent_opens) > 10000:
+            self._recent_opens = {
+                key: opened_at for key, opened_at in self._recent_opens.items()
+                if now - opened_at < OPEN_DEDUPE_WINDOW
+            }
+
+    async def bulk_access_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Массовая выдача (/grant) или отзыв (/revoke) доступа суперпользователем.
+        Строки "телефон домофон" передаются после команды или CSV-файлом с командой в подписи"""
+        message = update.message
+        session = await self.sessions.get(update.effective_chat.id)
+        if session is None or not self.sessions.phones.is_super_user(session['phone']):
+            await self.reply(message.reply_text, "❌ Команда доступна только суперпользователям")
+            return
+
+        parts = (message.text or message.caption or '').split(maxsplit=1)
+        action = parts[0].lstrip('/').split('@')[0]
+        body = parts[1] if len(parts) > 1 else ''
+        if message.document is not None:
+            file = await message.document.get_file()
+            body = (await file.download_as_bytearray()).decode('utf-8-sig')
+
+        rows = parse_access_rows(body)
+        if not rows:
+            await self.reply(
+                message.reply_text,
+                f"Передайте строки \"телефон домофон\" после /{action} или CSV-файл с /{action} в подписи"
+            )
+            return
+
+        job_id = await asyncio.to_thread(self.access_journal.create_job, action, rows, session['phone'])
+        await self.reply(message.reply_text, f"⏳ Задание {job_id}: {len(rows)} строк, выполняется")
+        context.application.create_task(self.run_bulk_access(message, job_id))
+
+    async def run_bulk_access(self, message, job_id: str):
+        """Выполнение задания и отправка отчета по строкам"""
+        if self.access_client is None:
+            from api_client import AsyncApiClient
+            self.access_client = AsyncApiClient(
+                settings.API_URL, settings.API_TOKEN,
+                phones=self.sessions.phones, access_journal=self.access_journal
+            )
+            self.access_client.add_access_listener(self.invalidate_phone)
+        try:
+            summary = await run_job(self.access_client, self.access_journal, job_id)
+        except Exception as e:
+            logger.error(f"Ошибка задания {job_id}: {e}")
+            await self.reply(
+                message.reply_text,
+                f"❌ Задание {job_id} прервано: {e}. Повторная отправка того же списка продолжит его"
+            )
+            return
+        report = await asyncio.to_thread(self.access_journal.report, job_id)
+        await self.reply(
+            message.reply_document,
+            report.encode(),
+            filename=f"access_{job_id}.csv",
+            caption=f"✅ Задание {job_id}: " + ", ".join(f"{status} {count}" for status, count in summary.items())
+        )
 
     async def check_api(self):
         """Проверка доступности API"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"{API_URL}/")
-                response.raise_for_status()
+            response = await self.http.get(f"{API_URL}/")
+            response.raise_for_status()
         except Exception as e:
             logger.error(f"API недоступен: {str(e)}")
             raise
 
+    async def start_webhook(self):
+        """Запуск приложения без polling: обновления приходят в webhook_server"""
+        check_webhook_secret()
+        await self.app.initialize()
+        await self.post_init(self.app)
+        await self.app.start()
+        self.updates = ChatOrderedProcessor(self.app, BOT_CONCURRENT_UPDATES)
+        if BOT_WEBHOOK_URL:
+            await self.app.bot.set_webhook(
+                url=BOT_WEBHOOK_URL,
+                secret_token=BOT_WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+
+    async def stop_webhook(self):
+        """Остановка приложения, запущенного через start_webhook"""
+        if self.updates is not None:
+            await self.updates.join()
+            self.updates = None
+        await self.app.stop()
+        await self.post_shutdown(self.app)
+        await self.app.shutdown()
+
+    async def process_webhook_update(self, data: dict):
+        """Передача обновления из webhook в очередь его чата: разные чаты обрабатываются
+        параллельно, а контакт и следующая за ним команда одного чата - по порядку"""
+        self.updates.submit(Update.de_json(data, self.app.bot))
+
     def run(self):
         """Запуск бота"""
-        self.app.run_polling()
+        if BOT_MODE == 'webhook':
+            check_webhook_secret()
+            # Обновления принимает тот же ASGI-сервер, что и вызовы домофона
+            import uvicorn
+            uvicorn.run('webhook_server:app', host='0.0.0.0', port=5000)
+        else:
+            self.app.run_polling()
 
 if __name__ == '__main__':
     bot = DomophoneBot()
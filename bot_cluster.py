@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+from telegram import Bot, Update
+from telegram.error import NetworkError, RetryAfter
+from telegram.ext import Application
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', str(os.cpu_count() or 1)))
+BOT_WORKER_CONCURRENCY = int(os.getenv('BOT_WORKER_CONCURRENCY', '64'))
+BOT_WORKER_QUEUE_SIZE = int(os.getenv('BOT_WORKER_QUEUE_SIZE', '10000'))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+# Наибольшая пауза между повторами getUpdates после сетевых ошибок
+POLL_BACKOFF_CAP = 30.0
+
+
+def create_bot():
+    """Фабрика бота для рабочего процесса"""
+    from bot import DomophoneBot
+    return DomophoneBot()
+
+
+def update_chat_id(update: Update) -> int:
+    """Чат, по которому шардируется обновление"""
+    chat = update.effective_chat
+    if chat is not None:
+        return chat.id
+    user = update.effective_user
+    return user.id if user is not None else 0
+
+
+class ChatOrderedProcessor:
+    """Обработка обновлений: разные чаты параллельно, не более concurrency сразу,
+    а обновления одного чата строго по очереди - каждое ждет предыдущее"""
+
+    def __init__(self, app: Application, concurrency: int):
+        self.app = app
+        self._chains: Dict[int, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def submit(self, update: Update):
+        """Поставить обновление в очередь его чата"""
+        chat_id = update_chat_id(update)
+        self._chains[chat_id] = asyncio.create_task(self._process(chat_id, update, self._chains.get(chat_id)))
+
+    async def join(self):
+        """Дождаться обработки всех принятых обновлений"""
+        await asyncio.gather(*self._chains.values(), return_exceptions=True)
+
+    async def _process(self, chat_id: int, update: Update, previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            async with self._semaphore:
+                await self.app.process_update(update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            if self._chains.get(chat_id) is asyncio.current_task():
+                del self._chains[chat_id]
+
+
+def worker_main(index: int, workers: int, queue, bot_factory: Callable):
+    """Точка входа рабочего процесса"""
+    # У каждого процесса свой порт /metrics: METRICS_PORT + 1 + index
+    metrics_port = int(os.getenv('METRICS_PORT', '0'))
+    if metrics_port:
+        os.environ['METRICS_PORT'] = str(metrics_port + 1 + index)
+    logging.basicConfig(
+        format=f'%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    asyncio.run(_run_worker(index, workers, queue, bot_factory))
+
+
+async def _run_worker(index: int, workers: int, queue, bot_factory: Callable):
+    bot = bot_factory()
+    # Чаты разделены между процессами, а общий лимит Telegram на бота - нет:
+    # каждый процесс расходует только свою долю
+    bot.scheduler.scale_global_rate(1 / workers)
+    app = bot.app
+    await app.initialize()
+    await bot.post_init(app)
+    await app.start()
+
+    processor = ChatOrderedProcessor(app, BOT_WORKER_CONCURRENCY)
+    logger.info(f"Обработчик {index} запущен")
+    try:
+        while True:
+            data = await asyncio.to_thread(queue.get)
+            if data is None:
+                break
+            processor.submit(Update.de_json(data, app.bot))
+        await processor.join()
+    finally:
+        await app.stop()
+        await bot.post_shutdown(app)
+        await app.shutdown()
+
+
+class BotCluster:
+    """Супервизор: раздает обновления рабочим процессам по chat_id
+    и перезапускает упавшие процессы"""
+
+    def __init__(self, workers: int = BOT_WORKERS, bot_factory: Callable = create_bot):
+        self.workers = workers
+        self.bot_factory = bot_factory
+        self._context = multiprocessing.get_context('spawn')
+        # Очереди принадлежат супервизору и переживают перезапуск процесса
+        self.queues = [self._context.Queue(BOT_WORKER_QUEUE_SIZE) for _ in range(workers)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.restarts = 0
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=worker_main,
+            args=(index, self.workers, self.queues[index], self.bot_factory),
+            name=f'bot-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def check_workers(self):
+        """Перезапуск упавших рабочих процессов"""
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.error(f"Обработчик {index} завершился с кодом {process.exitcode}, перезапуск")
+                self.restarts += 1
+                self._spawn(index)
+
+    def shard(self, chat_id: int) -> int:
+        return chat_id % self.workers
+
+    def route(self, update: Update):
+        """Передача обновления процессу, который обслуживает его чат"""
+        self.queues[self.shard(update_chat_id(update))].put(update.to_dict())
+
+    def stop(self, timeout: float = 30):
+        for queue in self.queues:
+            queue.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            if process is not None:
+                process.join(max(0, deadline - time.monotonic()))
+                if process.is_alive():
+                    process.terminate()
+
+    async def run_polling(self, poll_timeout: int = 30, check_interval: float = 5):
+        """Получение обновлений через getUpdates и раздача их рабочим процессам"""
+        bot = Bot(token=os.getenv('TELEGRAM_TOKEN'), base_url=TELEGRAM_API_URL)
+        offset = None
+        last_check = time.monotonic()
+        failures = 0
+        async with bot:
+            await bot.delete_webhook()
+            while True:
+                try:
+                    updates = await bot.get_updates(
+                        offset=offset, timeout=poll_timeout, allowed_updates=Update.ALL_TYPES
+                    )
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    if hasattr(retry_after, 'total_seconds'):
+                        retry_after = retry_after.total_seconds()
+                    await asyncio.sleep(retry_after)
+                    updates = []
+                except NetworkError as e:
+                    # TimedOut и прочие сетевые сбои временные: ждем и продолжаем опрос
+                    failures += 1
+                    delay = min(POLL_BACKOFF_CAP, 2 ** failures)
+                    logger.warning(f"Ошибка getUpdates: {e}, повтор через {delay:.0f} с")
+                    await asyncio.sleep(delay)
+                    updates = []
+                else:
+                    failures = 0
+                for update in updates:
+                    await asyncio.to_thread(self.route, update)
+                    offset = update.update_id + 1
+                if time.monotonic() - last_check > check_interval:
+                    self.check_workers()
+                    last_check = time.monotonic()
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    cluster = BotCluster()
+    cluster.start()
+    try:
+        asyncio.run(cluster.run_polling())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cluster.stop()
+
+
+if __name__ == '__main__':
+    main()
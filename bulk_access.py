@@ -0,0 +1,349 @@
+import asyncio
+import csv
+import hashlib
+import io
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from phones import DOMOPHONE_DB, normalize_phone
+
+logger = logging.getLogger(__name__)
+
+# Сколько запросов выдачи/отзыва доступа выполняется одновременно
+BULK_ACCESS_CONCURRENCY = int(os.getenv('BULK_ACCESS_CONCURRENCY', '8'))
+# Через сколько обработанных строк прогресс записывается в журнал
+BULK_ACCESS_FLUSH_SIZE = int(os.getenv('BULK_ACCESS_FLUSH_SIZE', '50'))
+# Сколько секунд известному состоянию доступа можно верить при пропуске строк:
+# изменения, сделанные в обход клиентов API, сюда не попадают
+ACCESS_STATE_MAX_AGE = float(os.getenv('ACCESS_STATE_MAX_AGE', '3600'))
+
+ACTION_GRANT = 'grant'
+ACTION_REVOKE = 'revoke'
+
+# Статусы строк задания
+PENDING = 'pending'
+DONE = 'done'
+SKIPPED = 'skipped'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+FAILED = 'failed'
+
+# Разделители CSV; если их нет в строке, поля разделяются пробелами
+_SEPARATORS = re.compile(r'[,;\t]')
+
+
+class AccessRow(NamedTuple):
+    row_no: int
+    phone: str
+    domofon_id: str
+    status: str = PENDING
+    detail: str = ''
+
+
+def parse_access_rows(text: str) -> List[AccessRow]:
+    """Разбор CSV или списка строк "телефон домофон"; строка заголовка пропускается,
+    неверные и повторяющиеся строки попадают в отчет со своим статусом"""
+    rows = []
+    seen: Set[Tuple[str, str]] = set()
+    first = True
+    for row_no, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        fields = _SEPARATORS.split(line) if _SEPARATORS.search(line) else line.split()
+        fields = [field.strip().strip('"\'') for field in fields if field.strip()]
+        if not fields:
+            continue
+        phone = normalize_phone(fields[0])
+        domofon_id = fields[1] if len(fields) > 1 else ''
+        is_first, first = first, False
+        if phone is None or not domofon_id.isdigit():
+            if is_first and not any(char.isdigit() for char in fields[0]):
+                # Первая непустая строка без цифр в поле телефона считается заголовком
+                continue
+            rows.append(AccessRow(row_no, fields[0], domofon_id, INVALID, 'неверный телефон или домофон'))
+            continue
+        if (phone, domofon_id) in seen:
+            rows.append(AccessRow(row_no, phone, domofon_id, DUPLICATE, 'повтор строки'))
+            continue
+        seen.add((phone, domofon_id))
+        rows.append(AccessRow(row_no, phone, domofon_id))
+    return rows
+
+
+def job_id_for(action: str, rows: List[AccessRow]) -> str:
+    """Отпечаток содержимого задания: по нему повторная загрузка того же списка
+    находит прерванное задание"""
+    digest = hashlib.sha1(action.encode())
+    for row in rows:
+        digest.update(f'\n{row.phone},{row.domofon_id}'.encode())
+    return digest.hexdigest()[:12]
+
+
+class AccessJournal:
+    """Журнал массовых заданий и известное состояние доступа в domophone.db"""
+
+    def __init__(self, path: str = DOMOPHONE_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS super_users (
+                phone_number TEXT PRIMARY KEY,
+                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS access_jobs (
+                job_id TEXT PRIMARY KEY,
+                action TEXT NOT NULL,
+                created_by TEXT,
+                created_at REAL NOT NULL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS access_job_rows (
+                job_id TEXT NOT NULL,
+                row_no INTEGER NOT NULL,
+                phone TEXT NOT NULL,
+                domofon_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                detail TEXT NOT NULL DEFAULT '',
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (job_id, row_no)
+            );
+            CREATE TABLE IF NOT EXISTS access_state (
+                phone TEXT NOT NULL,
+                domofon_id TEXT NOT NULL,
+                granted INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (phone, domofon_id)
+            );
+        ''')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def create_job(self, action: str, rows: List[AccessRow], created_by: Optional[str] = None) -> str:
+        """Сохранение задания. Незавершенное задание с тем же содержимым продолжается,
+        после завершенного создается новое: тот же список можно выполнить еще раз"""
+        digest = job_id_for(action, rows)
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                row = self._conn.execute(
+                    '''SELECT job_id FROM access_jobs
+                       WHERE (job_id = ? OR job_id GLOB ?) AND finished_at IS NULL
+                       ORDER BY created_at DESC LIMIT 1''',
+                    (digest, digest + '-*')
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute('COMMIT')
+                    return row[0]
+                job_id = f'{digest}-{int(now * 1000):x}'
+                self._conn.execute(
+                    'INSERT INTO access_jobs (job_id, action, created_by, created_at) VALUES (?, ?, ?, ?)',
+                    (job_id, action, created_by, now)
+                )
+                self._conn.executemany(
+                    '''INSERT INTO access_job_rows
+                       (job_id, row_no, phone, domofon_id, status, detail, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    [(job_id, *row, now) for row in rows]
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return job_id
+
+    def job_action(self, job_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute('SELECT action FROM access_jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def unfinished_rows(self, job_id: str) -> List[AccessRow]:
+        """Строки, которые еще нужно выполнить: новые и завершившиеся ошибкой"""
+        with self._lock:
+            rows = self._conn.execute(
+                '''SELECT row_no, phone, domofon_id, status, detail FROM access_job_rows
+                   WHERE job_id = ? AND status IN (?, ?) ORDER BY row_no''',
+                (job_id, PENDING, FAILED)
+            ).fetchall()
+        return [AccessRow(*row) for row in rows]
+
+    def pairs_in_state(
+        self, pairs: List[Tuple[str, str]], granted: bool, max_age: float = ACCESS_STATE_MAX_AGE
+    ) -> Set[Tuple[str, str]]:
+        """Пары (телефон, домофон), у которых доступ недавно был приведен в нужное состояние"""
+        result = set()
+        with self._lock:
+            for start in range(0, len(pairs), 400):
+                chunk = pairs[start:start + 400]
+                placeholders = ' OR '.join('(phone = ? AND domofon_id = ?)' for _ in chunk)
+                rows = self._conn.execute(
+                    f'''SELECT phone, domofon_id FROM access_state
+                        WHERE granted = ? AND updated_at > ? AND ({placeholders})''',
+                    (int(granted), time.time() - max_age, *(value for pair in chunk for value in pair))
+                ).fetchall()
+                result.update(rows)
+        return result
+
+    def set_state(self, pairs: List[Tuple[str, str]], granted: bool):
+        """Состояние доступа после успешного запроса к API; пишут его клиенты API"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                '''INSERT INTO access_state (phone, domofon_id, granted, updated_at)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT (phone, domofon_id) DO UPDATE SET
+                       granted = excluded.granted,
+                       updated_at = excluded.updated_at''',
+                [(phone, str(domofon_id), int(granted), now) for phone, domofon_id in pairs]
+            )
+
+    def record(self, job_id: str, rows: List[AccessRow]):
+        """Запись результатов строк одной транзакцией"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany(
+                    'UPDATE access_job_rows SET status = ?, detail = ?, updated_at = ? WHERE job_id = ? AND row_no = ?',
+                    [(row.status, row.detail, now, job_id, row.row_no) for row in rows]
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def finish(self, job_id: str):
+        with self._lock:
+            self._conn.execute('UPDATE access_jobs SET finished_at = ? WHERE job_id = ?', (time.time(), job_id))
+
+    def summary(self, job_id: str) -> Dict[str, int]:
+        """Количество строк задания по статусам"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT status, COUNT(*) FROM access_job_rows WHERE job_id = ? GROUP BY status',
+                (job_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def report(self, job_id: str) -> str:
+        """Отчет по строкам задания в CSV"""
+        with self._lock:
+            rows = self._conn.execute(
+                '''SELECT row_no, phone, domofon_id, status, detail FROM access_job_rows
+                   WHERE job_id = ? ORDER BY row_no''',
+                (job_id,)
+            ).fetchall()
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['row', 'phone', 'domofon_id', 'status', 'detail'])
+        writer.writerows(rows)
+        return output.getvalue()
+
+
+async def run_job(
+    client,
+    journal: AccessJournal,
+    job_id: str,
+    concurrency: int = BULK_ACCESS_CONCURRENCY,
+    flush_size: int = BULK_ACCESS_FLUSH_SIZE
+) -> Dict[str, int]:
+    """Выполнение (или продолжение) задания через grant_access/revoke_access клиента API"""
+    action = await asyncio.to_thread(journal.job_action, job_id)
+    if action not in (ACTION_GRANT, ACTION_REVOKE):
+        raise ValueError(f"Неизвестное задание {job_id}")
+    change_access = client.grant_access if action == ACTION_GRANT else client.revoke_access
+
+    rows = await asyncio.to_thread(journal.unfinished_rows, job_id)
+    in_state = await asyncio.to_thread(
+        journal.pairs_in_state, [(row.phone, row.domofon_id) for row in rows], action == ACTION_GRANT
+    )
+    pending = iter(rows)
+    results: List[AccessRow] = []
+
+    async def flush():
+        batch = results[:]
+        results.clear()
+        if batch:
+            await asyncio.to_thread(journal.record, job_id, batch)
+
+    async def worker():
+        # Все обработчики берут строки из одного итератора
+        for row in pending:
+            if (row.phone, row.domofon_id) in in_state:
+                results.append(row._replace(status=SKIPPED, detail='доступ уже в нужном состоянии'))
+            elif await change_access(row.phone, row.domofon_id):
+                results.append(row._replace(status=DONE, detail=''))
+            else:
+                results.append(row._replace(status=FAILED, detail='ошибка API'))
+            if len(results) >= flush_size:
+                await flush()
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    finally:
+        await flush()
+    await asyncio.to_thread(journal.finish, job_id)
+    return await asyncio.to_thread(journal.summary, job_id)
+
+
+def main():
+    """python bulk_access.py grant|revoke <файл.csv> или python bulk_access.py resume <job_id>"""
+    from api_client import AsyncApiClient
+    from shared_cache import SharedCache
+
+    load_dotenv()
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    if len(sys.argv) != 3 or sys.argv[1] not in (ACTION_GRANT, ACTION_REVOKE, 'resume'):
+        print(main.__doc__)
+        sys.exit(2)
+
+    journal = AccessJournal()
+    if sys.argv[1] == 'resume':
+        job_id = sys.argv[2]
+    else:
+        with open(sys.argv[2], encoding='utf-8-sig') as f:
+            rows = parse_access_rows(f.read())
+        job_id = journal.create_job(sys.argv[1], rows, created_by='cli')
+    print(f"Задание {job_id}")
+
+    shared_cache = SharedCache()
+
+    async def run():
+        async with AsyncApiClient(
+            os.getenv('DOMOPHONE_API_URL'), os.getenv('DOMOPHONE_API_TOKEN'), access_journal=journal
+        ) as client:
+            def invalidate_phone(phone: str):
+                # Бот не должен до истечения DOMOFONS_CACHE_TTL показывать старый список домофонов
+                tenant_id = client.phones.tenant_for(phone)
+                if tenant_id is not None:
+                    shared_cache.invalidate(f"domofons:{tenant_id}")
+
+            client.add_access_listener(invalidate_phone)
+            return await run_job(client, journal, job_id)
+
+    print(asyncio.run(run()))
+    report_path = f'access_{job_id}.csv'
+    with open(report_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(journal.report(job_id))
+    print(f"Отчет: {report_path}")
+    shared_cache.close()
+    journal.close()
+
+
+if __name__ == '__main__':
+    main()
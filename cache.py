@@ -0,0 +1,124 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+def json_size(value: Any) -> int:
+    """Оценка размера значения в байтах по его JSON-представлению"""
+    return len(json.dumps(value, ensure_ascii=False, default=str).encode())
+
+
+class TTLCache:
+    """Асинхронный LRU-кэш с TTL, ограничением памяти и single-flight"""
+
+    def __init__(
+        self,
+        ttl: float,
+        max_entries: int = 1000,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = json_size
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        # key -> (expires_at, size, value); порядок = порядок использования
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._generation: Dict[Hashable, int] = {}
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Значение из кэша без обращения к источнику"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Есть ли по ключу актуальное значение или идущая загрузка"""
+        return key in self._inflight or self.get(key) is not None
+
+    def set(self, key: Hashable, value: Any):
+        """Сохранение значения с вытеснением старых записей"""
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.size_bytes += size
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self.size_bytes > self.max_bytes
+        ):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """Сброс записи; загрузка, начатая до сброса, не попадет в кэш"""
+        self._remove(key)
+        # Поколение нужно только идущей загрузке и удаляется вместе с ней
+        if key in self._inflight:
+            self._generation[key] = self._generation.get(key, 0) + 1
+
+    def clear(self):
+        """Полная очистка кэша"""
+        for key in list(self._entries):
+            self.invalidate(key)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Чтение через кэш: параллельные промахи по ключу загружаются один раз"""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.hits += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        generation = self._generation.get(key, 0)
+        try:
+            value = await loader()
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим, здесь оно только пробрасывается
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if value is not None and self._generation.get(key, 0) == generation:
+                self.set(key, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+            self._generation.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики эффективности кэша"""
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry[1]
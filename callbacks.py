@@ -0,0 +1,39 @@
+from typing import NamedTuple, Optional, Tuple
+
+# Версия формата callback_data: v1:<действие>:<аргументы через двоеточие>
+CALLBACK_VERSION = 'v1'
+# Ограничение Telegram на длину callback_data
+CALLBACK_DATA_MAX_BYTES = 64
+
+ACTION_OPEN = 'open'
+ACTION_SNAPSHOT = 'snapshot'
+ACTION_SNAPSHOTS_ALL = 'snapshots'
+ACTION_HISTORY = 'history'
+
+
+class Callback(NamedTuple):
+    action: str
+    args: Tuple[str, ...]
+
+
+def encode_callback(action: str, *args) -> str:
+    """callback_data для кнопки"""
+    data = ':'.join((CALLBACK_VERSION, action, *(str(arg) for arg in args)))
+    if len(data.encode()) > CALLBACK_DATA_MAX_BYTES:
+        raise ValueError(f"callback_data длиннее {CALLBACK_DATA_MAX_BYTES} байт: {data}")
+    return data
+
+
+def parse_callback(data: Optional[str]) -> Optional[Callback]:
+    """Разбор callback_data; кнопки старого формата open_123 тоже принимаются"""
+    if not data:
+        return None
+    if data.startswith(CALLBACK_VERSION + ':'):
+        parts = data.split(':')
+        if len(parts) < 2 or not parts[1]:
+            return None
+        return Callback(parts[1], tuple(parts[2:]))
+    action, _, domofon_id = data.partition('_')
+    if action in (ACTION_OPEN, ACTION_SNAPSHOT) and domofon_id:
+        return Callback(action, (domofon_id,))
+    return None
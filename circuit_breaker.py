@@ -0,0 +1,62 @@
+import time
+
+
+class CircuitOpenError(Exception):
+    """Запрос отклонен: апстрим считается недоступным"""
+
+
+class CircuitBreaker:
+    """Предохранитель: после серии ошибок запросы сразу отклоняются.
+
+    closed    - запросы идут как обычно, ошибки подряд считаются;
+    open      - запросы отклоняются до истечения reset_timeout;
+    half_open - пропускается один пробный запрос, его результат
+                закрывает или снова размыкает цепь.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow_request(self) -> bool:
+        """Можно ли сейчас отправить запрос"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def check(self):
+        """То же, что allow_request, но с исключением"""
+        if not self.allow_request():
+            raise CircuitOpenError('Upstream circuit is open')
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def release(self):
+        """Запрос прерван без результата: пробный слот снова свободен"""
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
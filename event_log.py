@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Журнал событий хранится отдельно от domophone.db, как и очередь уведомлений
+EVENT_LOG_DB = os.getenv('EVENT_LOG_DB', 'events.db')
+EVENT_RETENTION_DAYS = int(os.getenv('EVENT_RETENTION_DAYS', '180'))
+EVENT_FLUSH_INTERVAL = float(os.getenv('EVENT_FLUSH_INTERVAL', '1'))
+EVENT_FLUSH_SIZE = int(os.getenv('EVENT_FLUSH_SIZE', '500'))
+EVENT_PURGE_INTERVAL = 3600
+
+EVENT_CALL = 'call'
+EVENT_OPEN = 'open'
+
+_PARTITION_PREFIX = 'events_'
+
+Cursor = Tuple[float, int]
+
+
+def partition_for(ts: float) -> str:
+    """Таблица месяца, в который попадает событие: events_YYYYMM"""
+    return f"{_PARTITION_PREFIX}{datetime.fromtimestamp(ts):%Y%m}"
+
+
+class EventLog:
+    """Журнал вызовов и открытий дверей: только добавление, помесячные таблицы.
+
+    События копятся в памяти и записываются пачками фоновой задачей: append()
+    вызывается из цикла событий и не ждет ни БД, ни чтения истории. Старые месяцы
+    удаляются целиком через DROP TABLE, без DELETE по миллионам строк.
+    """
+
+    def __init__(
+        self,
+        path: str = EVENT_LOG_DB,
+        retention_days: int = EVENT_RETENTION_DAYS,
+        flush_interval: float = EVENT_FLUSH_INTERVAL,
+        flush_size: int = EVENT_FLUSH_SIZE
+    ):
+        self.path = path
+        self.retention_days = retention_days
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending: List[tuple] = []
+        self._partitions = set()
+        # _lock - соединение с БД, _pending_lock - только короткая работа с буфером
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._purged_at = 0.0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+
+    def start(self):
+        """Запуск периодической записи событий и удаления старых месяцев"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.to_thread(self.flush)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+    def append(
+        self,
+        kind: str,
+        tenant_id: int,
+        domofon_id: int,
+        chat_id: Optional[int] = None,
+        door_id: Optional[int] = None,
+        status: str = 'ok',
+        ts: Optional[float] = None
+    ):
+        """Добавление события; в БД оно попадет со следующей пачкой"""
+        # Столбцы INTEGER сами приводят идентификаторы, пришедшие строками
+        event = (ts or time.time(), kind, tenant_id, domofon_id, chat_id, door_id, status)
+        with self._pending_lock:
+            self._pending.append(event)
+            flush_now = len(self._pending) >= self.flush_size
+        if flush_now:
+            # Записью занимается фоновая задача, цикл событий ее не ждет
+            self._wakeup.set()
+
+    def flush(self):
+        """Запись накопленных событий одной транзакцией"""
+        with self._lock:
+            # Буфер забирается целиком, и append() не ждет окончания записи
+            with self._pending_lock:
+                if not self._pending:
+                    return
+                pending, self._pending = self._pending, []
+            by_partition: Dict[str, List[tuple]] = {}
+            for event in pending:
+                by_partition.setdefault(partition_for(event[0]), []).append(event)
+            self._conn.execute('BEGIN')
+            try:
+                for table, events in by_partition.items():
+                    self._ensure_partition(table)
+                    self._conn.executemany(
+                        f'''INSERT INTO {table} (ts, kind, tenant_id, domofon_id, chat_id, door_id, status)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                        events
+                    )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                # Пачка вернется в буфер перед событиями, добавленными за время записи
+                with self._pending_lock:
+                    self._pending = pending + self._pending
+                raise
+
+    def _ensure_partition(self, table: str):
+        if table in self._partitions:
+            return
+        # executescript завершил бы открытую транзакцию, поэтому по одному запросу
+        self._conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                kind TEXT NOT NULL,
+                tenant_id INTEGER NOT NULL,
+                domofon_id INTEGER NOT NULL,
+                chat_id INTEGER,
+                door_id INTEGER,
+                status TEXT NOT NULL
+            )
+        ''')
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_tenant ON {table} (tenant_id, ts, id)')
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_domofon ON {table} (domofon_id, ts, id)')
+        self._partitions.add(table)
+
+    def _partition_names(self) -> List[str]:
+        """Месячные таблицы от новых к старым (в том числе созданные другими процессами)"""
+        rows = self._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ?",
+            (_PARTITION_PREFIX + '[0-9][0-9][0-9][0-9][0-9][0-9]',)
+        ).fetchall()
+        return sorted((row[0] for row in rows), reverse=True)
+
+    def purge(self, now: Optional[float] = None) -> int:
+        """Удаление месяцев, целиком вышедших за срок хранения"""
+        now = now or time.time()
+        # Удаляются месяцы раньше того, в который попадает граница срока хранения
+        oldest_kept = partition_for(
+            (datetime.fromtimestamp(now) - timedelta(days=self.retention_days)).timestamp()
+        )
+        dropped = 0
+        with self._lock:
+            for table in self._partition_names():
+                if table < oldest_kept:
+                    self._conn.execute(f'DROP TABLE IF EXISTS {table}')
+                    self._partitions.discard(table)
+                    dropped += 1
+        if dropped:
+            logger.info(f"Удалено месяцев журнала событий: {dropped}")
+        return dropped
+
+    def tenant_history(self, tenant_id: int, limit: int = 10, before: Optional[Cursor] = None):
+        """Страница событий жильца от новых к старым и курсор следующей страницы"""
+        return self._page('tenant_id', int(tenant_id), limit, before)
+
+    def domofon_history(self, domofon_id: int, limit: int = 10, before: Optional[Cursor] = None):
+        """Страница событий домофона от новых к старым и курсор следующей страницы"""
+        return self._page('domofon_id', int(domofon_id), limit, before)
+
+    def _page(self, column: str, value: int, limit: int, before: Optional[Cursor]):
+        # Курсор (ts, id) последнего показанного события: страница читается по индексу
+        # с позиции курсора, без OFFSET, и одинаково быстра на любой глубине
+        self.flush()
+        events = []
+        with self._lock:
+            for table in self._partition_names():
+                if before is not None and table > partition_for(before[0]):
+                    continue
+                if before is None:
+                    query = f'''SELECT id, ts, kind, tenant_id, domofon_id, chat_id, door_id, status
+                                FROM {table} WHERE {column} = ?
+                                ORDER BY ts DESC, id DESC LIMIT ?'''
+                    params = (value, limit + 1 - len(events))
+                else:
+                    query = f'''SELECT id, ts, kind, tenant_id, domofon_id, chat_id, door_id, status
+                                FROM {table} WHERE {column} = ? AND (ts, id) < (?, ?)
+                                ORDER BY ts DESC, id DESC LIMIT ?'''
+                    params = (value, before[0], before[1], limit + 1 - len(events))
+                events.extend(self._row_to_event(row) for row in self._conn.execute(query, params))
+                if len(events) > limit:
+                    break
+        next_cursor = None
+        if len(events) > limit:
+            events = events[:limit]
+            next_cursor = (events[-1]['ts'], events[-1]['id'])
+        return events, next_cursor
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+                if time.time() - self._purged_at > EVENT_PURGE_INTERVAL:
+                    self._purged_at = time.time()
+                    await asyncio.to_thread(self.purge)
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала событий: {e}")
+
+    @staticmethod
+    def _row_to_event(row) -> Dict:
+        return {
+            'id': row[0],
+            'ts': row[1],
+            'kind': row[2],
+            'tenant_id': row[3],
+            'domofon_id': row[4],
+            'chat_id': row[5],
+            'door_id': row[6],
+            'status': row[7]
+        }
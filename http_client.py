@@ -0,0 +1,46 @@
+import importlib.util
+import os
+from typing import Dict
+
+import httpx
+
+from metrics import InstrumentedTransport
+
+# Лимиты пула соединений к API домофонов
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '60'))
+
+# HTTP/2 включается только если установлен пакет h2 (httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+HTTP2_ENABLED = HTTP2_AVAILABLE and os.getenv('HTTP2_ENABLED', '1') == '1'
+
+DEFAULT_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+
+# Таймауты по эндпоинтам: открытие двери должно отвечать быстро,
+# снимки и списки квартир могут грузиться дольше
+ENDPOINT_TIMEOUTS: Dict[str, httpx.Timeout] = {
+    'check-tenant': httpx.Timeout(5.0, connect=3.0),
+    'domo.apartment': httpx.Timeout(8.0, connect=3.0),
+    'domofon': httpx.Timeout(8.0, connect=3.0),
+    'urlsOnType': httpx.Timeout(8.0, connect=3.0),
+    'open': httpx.Timeout(4.0, connect=2.0),
+    'get-snapshot': httpx.Timeout(15.0, connect=3.0),
+}
+
+
+def timeout_for(endpoint: str) -> httpx.Timeout:
+    """Таймаут для эндпоинта API"""
+    return ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+
+
+def build_async_client(**kwargs) -> httpx.AsyncClient:
+    """Создание долгоживущего клиента с пулом соединений"""
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    transport = httpx.AsyncHTTPTransport(limits=limits, http2=HTTP2_ENABLED)
+    return httpx.AsyncClient(transport=InstrumentedTransport(transport), **kwargs)
@@ -0,0 +1,153 @@
+import functools
+import os
+import random
+import re
+import time
+from typing import Callable, Dict
+
+import httpx
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+# Доля запросов, для которых в лог пишется полное тело ответа
+LOG_BODY_SAMPLE_RATE = float(os.getenv('LOG_BODY_SAMPLE_RATE', '0.01'))
+# Порт /metrics для бота в режиме polling; 0 - не запускать
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+UPSTREAM_LATENCY = Histogram(
+    'domophone_upstream_request_seconds',
+    'Время запросов к API домофонов',
+    ['endpoint', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+HANDLER_LATENCY = Histogram(
+    'domophone_handler_seconds',
+    'Время обработчиков бота и webhook',
+    ['handler'],
+    buckets=LATENCY_BUCKETS
+)
+TELEGRAM_SEND_LATENCY = Histogram(
+    'domophone_telegram_send_seconds',
+    'Время отправки сообщений в Telegram',
+    ['priority', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+RING_TO_NOTIFICATION = Histogram(
+    'domophone_ring_to_notification_seconds',
+    'Время от приема вызова до отправки уведомления',
+    buckets=LATENCY_BUCKETS + (60, 300)
+)
+DOOR_OPEN_LATENCY = Histogram(
+    'domophone_door_open_seconds',
+    'Время от нажатия "Открыть" до ответа API открытия двери',
+    ['status'],
+    buckets=LATENCY_BUCKETS
+)
+DOOR_OPEN_REPLY_LATENCY = Histogram(
+    'domophone_door_open_reply_seconds',
+    'Время от нажатия "Открыть" до сообщения о результате',
+    ['status'],
+    buckets=LATENCY_BUCKETS
+)
+DOOR_OPEN_DUPLICATES = Counter(
+    'domophone_door_open_duplicates_total',
+    'Повторные нажатия "Открыть", не отправленные в API'
+)
+PREFETCH_TASKS = Counter(
+    'domophone_prefetch_tasks_total',
+    'Задачи предзагрузки по результату',
+    ['result']
+)
+PREFETCH_LOOKUPS = Counter(
+    'domophone_prefetch_lookups_total',
+    'Обращения к данным, которые могла подготовить предзагрузка',
+    ['kind', 'result']
+)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def endpoint_label(path: str) -> str:
+    """Путь запроса без идентификаторов: /domo.apartment/12/domofon -> /domo.apartment/:id/domofon"""
+    return _ID_SEGMENT.sub('/:id', path)
+
+
+def should_log_body() -> bool:
+    """Нужно ли писать тело ответа в лог для этого запроса"""
+    return random.random() < LOG_BODY_SAMPLE_RATE
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Транспорт httpx, замеряющий время до заголовков ответа. В отличие от хуков
+    событий учитывает и запросы без ответа: status timeout или error"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started_at = time.perf_counter()
+        status = 'error'
+        try:
+            response = await self.transport.handle_async_request(request)
+            status = str(response.status_code)
+            return response
+        except httpx.TimeoutException:
+            status = 'timeout'
+            raise
+        finally:
+            UPSTREAM_LATENCY.labels(endpoint_label(request.url.path), status).observe(
+                time.perf_counter() - started_at
+            )
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def observe_handler(name: str):
+    """Декоратор: гистограмма времени выполнения асинхронного обработчика"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                HANDLER_LATENCY.labels(name).observe(time.perf_counter() - started_at)
+        return wrapper
+    return decorator
+
+
+_collectors: Dict[str, '_CallbackCollector'] = {}
+
+
+class _CallbackCollector:
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Dict[str, float]]):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def collect(self):
+        family = GaugeMetricFamily(self.name, self.documentation, labels=['key'])
+        for key, value in self.callback().items():
+            if isinstance(value, (int, float)):
+                family.add_metric([key], value)
+        yield family
+
+
+def register_stats(name: str, documentation: str, callback: Callable[[], Dict[str, float]]):
+    """Экспорт словаря счетчиков (stats() кэшей, очередей) как метрики"""
+    collector = _collectors.get(name)
+    if collector is not None:
+        collector.callback = callback
+        return
+    collector = _collectors[name] = _CallbackCollector(name, documentation, callback)
+    REGISTRY.register(collector)
+
+
+def render() -> bytes:
+    """Метрики в текстовом формате Prometheus"""
+    return generate_latest(REGISTRY)
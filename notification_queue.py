@@ -0,0 +1,272 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Очередь хранится рядом с domophone.db
+NOTIFY_QUEUE_DB = os.getenv('NOTIFY_QUEUE_DB', 'notifications.db')
+
+PENDING = 'pending'
+DONE = 'done'
+DEAD = 'dead'
+
+
+def call_idempotency_key(domofon_id, tenant_id, ring_ts) -> str:
+    """Ключ идемпотентности вызова: повторный webhook того же звонка не дублируется"""
+    return f"{domofon_id}:{tenant_id}:{ring_ts}"
+
+
+class NotificationQueue:
+    """Персистентная очередь уведомлений о вызовах в SQLite (WAL)"""
+
+    def __init__(
+        self,
+        path: str = NOTIFY_QUEUE_DB,
+        max_attempts: int = 5,
+        backoff_base: float = 2.0,
+        backoff_cap: float = 300.0,
+        lease: float = 60.0
+    ):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        # Сколько секунд взятая задача невидима для других обработчиков;
+        # если обработчик упал, задача будет выдана снова (at-least-once)
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS notifications (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                available_at REAL NOT NULL,
+                last_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_notifications_ready
+                ON notifications (status, available_at);
+        ''')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def enqueue(self, idempotency_key: str, payload: Dict) -> bool:
+        """Добавление уведомления; False, если такой ключ уже был"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                '''INSERT OR IGNORE INTO notifications
+                   (idempotency_key, payload, created_at, available_at)
+                   VALUES (?, ?, ?, ?)''',
+                (idempotency_key, json.dumps(payload), now, now)
+            )
+        return cursor.rowcount == 1
+
+    def dequeue(self, batch_size: int) -> List[Tuple[int, Dict, int]]:
+        """Выдача пачки готовых уведомлений: (id, payload, attempts)"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(
+                    '''SELECT id, payload, attempts FROM notifications
+                       WHERE status = ? AND available_at <= ?
+                       ORDER BY available_at LIMIT ?''',
+                    (PENDING, now, batch_size)
+                ).fetchall()
+                self._conn.executemany(
+                    'UPDATE notifications SET available_at = ? WHERE id = ?',
+                    [(now + self.lease, row[0]) for row in rows]
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return [(row[0], json.loads(row[1]), row[2]) for row in rows]
+
+    def ack(self, ids: List[int]):
+        """Отметка об успешной доставке"""
+        if not ids:
+            return
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE notifications SET status = ? WHERE id = ?',
+                [(DONE, notification_id) for notification_id in ids]
+            )
+
+    def retry(self, notification_id: int, attempts: int, error: str):
+        """Повтор с экспоненциальной задержкой или перенос в dead letter"""
+        attempts += 1
+        if attempts >= self.max_attempts:
+            status, available_at = DEAD, time.time()
+            logger.error(f"Уведомление {notification_id} перенесено в dead letter: {error}")
+        else:
+            delay = min(self.backoff_cap, self.backoff_base * 2 ** attempts)
+            status, available_at = PENDING, time.time() + random.uniform(delay / 2, delay)
+        with self._lock:
+            self._conn.execute(
+                '''UPDATE notifications
+                   SET status = ?, attempts = ?, available_at = ?, last_error = ?
+                   WHERE id = ?''',
+                (status, attempts, available_at, error, notification_id)
+            )
+
+    def purge(self, older_than: float):
+        """Удаление доставленных записей старше older_than секунд"""
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM notifications WHERE status = ? AND created_at < ?',
+                (DONE, time.time() - older_than)
+            )
+
+    def depth(self) -> int:
+        """Количество уведомлений, ожидающих доставки"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM notifications WHERE status = ?', (PENDING,)
+            ).fetchone()[0]
+
+    def stats(self) -> Dict[str, float]:
+        """Глубина очереди, число dead letter и задержка доставки"""
+        with self._lock:
+            depth, oldest = self._conn.execute(
+                'SELECT COUNT(*), MIN(created_at) FROM notifications WHERE status = ?',
+                (PENDING,)
+            ).fetchone()
+            dead = self._conn.execute(
+                'SELECT COUNT(*) FROM notifications WHERE status = ?', (DEAD,)
+            ).fetchone()[0]
+        return {
+            'depth': depth,
+            'dead': dead,
+            'lag_seconds': time.time() - oldest if oldest else 0.0
+        }
+
+
+class DeliveryWorker:
+    """Обработчик очереди: держит до concurrency доставок одновременно и
+    забирает новые уведомления по мере освобождения мест"""
+
+    def __init__(
+        self,
+        queue: NotificationQueue,
+        handler: Callable[[Dict], Awaitable[None]],
+        concurrency: int = 16,
+        batch_size: int = 50,
+        poll_interval: float = 0.5,
+        retention: float = 24 * 3600,
+        depth_interval: float = 1.0
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.depth_interval = depth_interval
+        self.delivered = 0
+        self.retried = 0
+        self.last_delivery_lag = 0.0
+        # Глубина очереди, обновляемая раз в depth_interval, для быстрой проверки при приеме
+        self.depth = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        """Разбудить обработчик после постановки нового уведомления"""
+        self._wakeup.set()
+
+    def start(self, deliver: bool = True):
+        """Запуск доставки; при deliver=False только отслеживается глубина очереди"""
+        self._task = asyncio.create_task(self.run() if deliver else self.track_depth())
+
+    async def track_depth(self):
+        """Обновление глубины очереди, когда доставка идет в другом процессе"""
+        while True:
+            self.depth = await asyncio.to_thread(self.queue.depth)
+            await asyncio.sleep(self.poll_interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self):
+        in_flight: Set[asyncio.Task] = set()
+        last_purge = time.monotonic()
+        last_depth = float('-inf')
+        try:
+            while True:
+                now = time.monotonic()
+                if now - last_depth >= self.depth_interval:
+                    self.depth = await asyncio.to_thread(self.queue.depth)
+                    last_depth = now
+                if now - last_purge > 3600:
+                    await asyncio.to_thread(self.queue.purge, self.retention)
+                    last_purge = now
+
+                # Уведомления берутся только на свободные места: каждое выдается
+                # непосредственно перед доставкой и не ждет чужих медленных доставок
+                free = min(self.concurrency - len(in_flight), self.batch_size)
+                if free > 0:
+                    self._wakeup.clear()
+                    batch = await asyncio.to_thread(self.queue.dequeue, free)
+                    for notification_id, payload, attempts in batch:
+                        task = asyncio.create_task(self._deliver(notification_id, payload, attempts))
+                        in_flight.add(task)
+                        task.add_done_callback(in_flight.discard)
+                    if len(batch) == free:
+                        continue
+
+                # Ждем освобождения места, нового уведомления или следующего опроса
+                waiters = set(in_flight)
+                wakeup = None
+                if free > 0:
+                    wakeup = asyncio.create_task(self._wakeup.wait())
+                    waiters.add(wakeup)
+                await asyncio.wait(waiters, timeout=self.poll_interval, return_when=asyncio.FIRST_COMPLETED)
+                if wakeup is not None:
+                    wakeup.cancel()
+        finally:
+            # Незавершенные уведомления будут выданы снова после истечения lease
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+    async def _deliver(self, notification_id: int, payload: Dict, attempts: int):
+        """Доставка одного уведомления с подтверждением или повтором"""
+        try:
+            await self.handler(payload)
+        except Exception as e:
+            logger.warning(f"Ошибка доставки уведомления {payload}: {e}")
+            self.retried += 1
+            await asyncio.to_thread(self.queue.retry, notification_id, attempts, str(e))
+            return
+        self.last_delivery_lag = time.time() - payload.get('received_at', time.time())
+        await asyncio.to_thread(self.queue.ack, [notification_id])
+        self.delivered += 1
+
+    def stats(self) -> Dict[str, float]:
+        stats = self.queue.stats()
+        stats.update({
+            'delivered': self.delivered,
+            'retried': self.retried,
+            'last_delivery_lag_seconds': self.last_delivery_lag
+        })
+        return stats
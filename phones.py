@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+DOMOPHONE_DB = os.getenv('DOMOPHONE_DB', 'domophone.db')
+# Как часто индекс подхватывает сессии, сохраненные другими процессами
+PHONE_INDEX_REFRESH_INTERVAL = float(os.getenv('PHONE_INDEX_REFRESH_INTERVAL', '5'))
+# Сессии сбрасываются в БД пачками позже времени сохранения, поэтому каждое
+# обновление перечитывает и последние секунды до предыдущего
+PHONE_INDEX_REFRESH_OVERLAP = 60.0
+
+_NON_DIGITS = re.compile(r'\D+')
+
+
+def normalize_phone(value) -> Optional[str]:
+    """Телефон в каноническом виде: только цифры, российский номер как 7XXXXXXXXXX.
+    None, если это не похоже на телефон"""
+    if isinstance(value, int):
+        value = str(value)
+    # Частый случай - номер уже в каноническом виде, новая строка не создается
+    if len(value) == 11 and value[0] == '7' and value.isdigit():
+        return value
+    digits = value if value.isdigit() else _NON_DIGITS.sub('', value)
+    if value.lstrip().startswith('+'):
+        # Номер с + уже содержит код страны, дописывать 7 или менять 8 нельзя
+        return digits if 11 <= len(digits) <= 15 else None
+    if len(digits) == 10:
+        return '7' + digits
+    if len(digits) == 11 and digits[0] == '8':
+        return '7' + digits[1:]
+    if 11 <= len(digits) <= 15:
+        return digits
+    return None
+
+
+class PhoneIndex:
+    """Индекс в памяти: телефон -> tenant_id из сессий и множество суперпользователей
+    из domophone.db. Загружается целиком при создании, дальше дочитывает только
+    сессии, измененные после последнего обновления"""
+
+    def __init__(self, path: str = DOMOPHONE_DB, refresh_interval: float = PHONE_INDEX_REFRESH_INTERVAL):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._tenants: Dict[str, int] = {}
+        self._super_users: Set[str] = set()
+        self._updated_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self.refresh()
+
+    def start(self):
+        """Запуск периодического обновления индекса"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def refresh(self):
+        """Дочитывание новых сессий и перечитывание суперпользователей (таблица маленькая,
+        а удаление из нее по времени не отследить)"""
+        with self._lock:
+            try:
+                rows = self._conn.execute(
+                    'SELECT phone, tenant_id, updated_at FROM sessions WHERE updated_at > ? ORDER BY updated_at',
+                    (self._updated_at - PHONE_INDEX_REFRESH_OVERLAP,)
+                ).fetchall()
+            except sqlite3.OperationalError:
+                # Таблицы еще нет: ее создает SessionStore
+                rows = []
+            try:
+                super_users = self._conn.execute('SELECT phone_number FROM super_users').fetchall()
+            except sqlite3.OperationalError:
+                super_users = []
+        for phone, tenant_id, updated_at in rows:
+            self._tenants[phone] = tenant_id
+            self._updated_at = max(self._updated_at, updated_at)
+        self._super_users = {
+            phone for phone in (normalize_phone(row[0]) for row in super_users) if phone is not None
+        }
+
+    def add(self, phone: str, tenant_id: int):
+        """Учет сессии, сохраненной этим процессом, без ожидания обновления"""
+        self._tenants[phone] = tenant_id
+
+    def tenant_for(self, phone) -> Optional[int]:
+        """tenant_id по телефону в любом формате"""
+        phone = normalize_phone(phone)
+        return self._tenants.get(phone) if phone is not None else None
+
+    def is_super_user(self, phone) -> bool:
+        phone = normalize_phone(phone)
+        return phone is not None and phone in self._super_users
+
+    def stats(self) -> Dict[str, int]:
+        return {'phones': len(self._tenants), 'super_users': len(self._super_users)}
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logger.error(f"Ошибка обновления индекса телефонов: {e}")
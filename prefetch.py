@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Set
+
+from metrics import PREFETCH_LOOKUPS, PREFETCH_TASKS
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', '1') == '1'
+# Сколько задач предзагрузки выполняется одновременно, чтобы не занимать
+# пул соединений, нужный интерактивным запросам
+PREFETCH_CONCURRENCY = int(os.getenv('PREFETCH_CONCURRENCY', '4'))
+# Задача, прождавшая свободный слот дольше, уже бесполезна и пропускается
+PREFETCH_MAX_DELAY = float(os.getenv('PREFETCH_MAX_DELAY', '10'))
+PREFETCH_MAX_WARMED = 100000
+
+
+class Prefetcher:
+    """Фоновая предзагрузка данных, которые скорее всего понадобятся следующему запросу.
+
+    У каждого владельца (чата) не больше одной задачи: новая задача отменяет
+    предыдущую, если та еще ждет слота. Начатую задачу не отменяем, к ее
+    загрузке уже могли присоединиться интерактивные запросы.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = PREFETCH_CONCURRENCY,
+        max_delay: float = PREFETCH_MAX_DELAY,
+        enabled: bool = PREFETCH_ENABLED
+    ):
+        self.max_delay = max_delay
+        self.enabled = enabled
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._running: Set[asyncio.Task] = set()
+        # (вид, ключ) данных, подготовленных предзагрузкой и еще не запрошенных
+        self._warmed: 'OrderedDict[tuple, float]' = OrderedDict()
+
+    def schedule(self, owner: Hashable, job: Callable[[], Awaitable]) -> Optional[asyncio.Task]:
+        """Запуск предзагрузки в фоне"""
+        if not self.enabled:
+            return None
+        self.cancel(owner)
+        task = asyncio.create_task(self._run(owner, job, time.monotonic()))
+        self._tasks[owner] = task
+        return task
+
+    def cancel(self, owner: Hashable):
+        """Отмена задачи владельца, если она еще не начала выполняться"""
+        task = self._tasks.get(owner)
+        if task is not None and task not in self._running:
+            task.cancel()
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, owner: Hashable, job: Callable[[], Awaitable], queued_at: float):
+        task = asyncio.current_task()
+        result = 'done'
+        try:
+            async with self._slots:
+                if time.monotonic() - queued_at > self.max_delay:
+                    result = 'expired'
+                    return
+                self._running.add(task)
+                await job()
+        except asyncio.CancelledError:
+            result = 'cancelled'
+            raise
+        except Exception as e:
+            result = 'error'
+            logger.warning(f"Ошибка предзагрузки для {owner}: {e}")
+        finally:
+            self._running.discard(task)
+            if self._tasks.get(owner) is task:
+                del self._tasks[owner]
+            PREFETCH_TASKS.labels(result).inc()
+
+    def mark(self, kind: str, key: Hashable):
+        """Отметка данных, загруженных предзагрузкой"""
+        self._warmed[(kind, key)] = time.monotonic()
+        self._warmed.move_to_end((kind, key))
+        while len(self._warmed) > PREFETCH_MAX_WARMED:
+            self._warmed.popitem(last=False)
+
+    def record(self, kind: str, key: Hashable, warm: bool):
+        """Учет обращения интерактивного запроса: hit - данные подготовила предзагрузка
+        и они еще в кэше, miss - подготовила, но они уже устарели, none - не готовила"""
+        if self._warmed.pop((kind, key), None) is None:
+            result = 'none'
+        else:
+            result = 'hit' if warm else 'miss'
+        PREFETCH_LOOKUPS.labels(kind, result).inc()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'scheduled': len(self._tasks),
+            'running': len(self._running),
+            'warmed': len(self._warmed)
+        }
@@ -0,0 +1,255 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from telegram.error import RetryAfter
+
+from metrics import TELEGRAM_SEND_LATENCY
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и 1 в секунду на чат,
+# по умолчанию общий лимит взят с запасом
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '25'))
+TELEGRAM_GLOBAL_BURST = float(os.getenv('TELEGRAM_GLOBAL_BURST', '5'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', '2'))
+# Доля общего лимита для уведомлений о вызовах, когда их отправляет не тот процесс,
+# что отвечает на команды бота; остальное достается боту
+TELEGRAM_CALLS_RATE_SHARE = float(os.getenv('TELEGRAM_CALLS_RATE_SHARE', '0.5'))
+# Повторные звонки в тот же домофон в пределах окна объединяются в одно сообщение
+RING_COALESCE_WINDOW = float(os.getenv('RING_COALESCE_WINDOW', '15'))
+
+PRIORITY_CALL = 0
+PRIORITY_INFO = 1
+PRIORITY_NAMES = {PRIORITY_CALL: 'call', PRIORITY_INFO: 'info'}
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не более capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class _Job:
+    __slots__ = ('chat_id', 'send', 'future', 'coalesce_key', 'attempts', 'enqueued_at')
+
+    def __init__(self, chat_id, send, future, coalesce_key):
+        self.chat_id = chat_id
+        self.send = send
+        self.future = future
+        self.coalesce_key = coalesce_key
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+
+class SendScheduler:
+    """Единая очередь исходящих отправок в Telegram.
+
+    Отправка выполняется, когда есть токен и в общем ведре, и в ведре чата;
+    среди готовых задач первыми идут уведомления о вызовах.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = TELEGRAM_GLOBAL_RATE,
+        global_burst: float = TELEGRAM_GLOBAL_BURST,
+        chat_rate: float = TELEGRAM_CHAT_RATE,
+        chat_burst: float = TELEGRAM_CHAT_BURST,
+        coalesce_window: float = RING_COALESCE_WINDOW,
+        max_in_flight: int = 64,
+        max_retries: int = 3
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self._chat_buckets: Dict[Any, TokenBucket] = {}
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self._recent: Dict[Hashable, tuple] = {}
+        self._paused_until = 0.0
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def scale_global_rate(self, share: float):
+        """Доля общего лимита бота для одного из нескольких процессов, отправляющих от его имени"""
+        bucket = self.global_bucket
+        self.global_bucket = TokenBucket(bucket.rate * share, max(1.0, bucket.capacity * share))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def send(
+        self,
+        chat_id,
+        send: Callable[[], Awaitable[Any]],
+        priority: int = PRIORITY_INFO,
+        coalesce_key: Optional[Hashable] = None
+    ) -> Any:
+        """Поставить отправку в очередь и дождаться ее результата"""
+        if coalesce_key is not None:
+            pending = self._pending.get(coalesce_key)
+            if pending is not None:
+                self.coalesced += 1
+                return await asyncio.shield(pending)
+            recent = self._recent.get(coalesce_key)
+            if recent is not None and time.monotonic() - recent[0] < self.coalesce_window:
+                self.coalesced += 1
+                return recent[1]
+
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(chat_id, send, future, coalesce_key)
+        if coalesce_key is not None:
+            self._pending[coalesce_key] = future
+        self._push(priority, job)
+        self.start()
+        return await future
+
+    def _push(self, priority: int, job: _Job):
+        heapq.heappush(self._heap, (priority, next(self._seq), job))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _pick(self, now: float):
+        """Первая по приоритету задача, чат которой может отправлять; иначе время ожидания"""
+        wait = None
+        for entry in sorted(self._heap):
+            chat_delay = self._chat_bucket(entry[2].chat_id).delay(now)
+            if chat_delay == 0:
+                return entry, wait
+            wait = chat_delay if wait is None else min(wait, chat_delay)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            delay = max(self._paused_until - now, self.global_bucket.delay(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            entry, wait = self._pick(now)
+            if entry is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._heap.remove(entry)
+            heapq.heapify(self._heap)
+            priority, _, job = entry
+            self.global_bucket.consume()
+            self._chat_bucket(job.chat_id).consume()
+            await self._in_flight.acquire()
+            asyncio.create_task(self._execute(priority, job))
+            self._prune(now)
+
+    async def _execute(self, priority: int, job: _Job):
+        started_at = time.perf_counter()
+        status = 'ok'
+        try:
+            result = await job.send()
+        except RetryAfter as e:
+            status = 'retry_after'
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            self.rate_limited += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            job.attempts += 1
+            if job.attempts <= self.max_retries:
+                logger.warning(f"Telegram просит подождать {retry_after}с, отправка в чат {job.chat_id} отложена")
+                self._push(priority, job)
+            else:
+                self._finish(job, error=e)
+        except Exception as e:
+            status = 'error'
+            self._finish(job, error=e)
+        else:
+            self.sent += 1
+            self._finish(job, result=result)
+        finally:
+            self._in_flight.release()
+            TELEGRAM_SEND_LATENCY.labels(PRIORITY_NAMES.get(priority, str(priority)), status).observe(
+                time.perf_counter() - started_at
+            )
+
+    def _finish(self, job: _Job, result: Any = None, error: Optional[BaseException] = None):
+        if job.coalesce_key is not None:
+            self._pending.pop(job.coalesce_key, None)
+            if error is None:
+                self._recent[job.coalesce_key] = (time.monotonic(), result)
+        if job.future.done():
+            return
+        if error is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(error)
+
+    def _prune(self, now: float):
+        if len(self._recent) > 10000:
+            self._recent = {
+                key: value for key, value in self._recent.items()
+                if now - value[0] < self.coalesce_window
+            }
+        if len(self._chat_buckets) > 10000:
+            self._chat_buckets = {
+                chat_id: bucket for chat_id, bucket in self._chat_buckets.items()
+                if bucket.tokens < bucket.capacity
+            }
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'queued': len(self._heap),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'rate_limited': self.rate_limited
+        }
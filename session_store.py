@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from cache import TTLCache
+from phones import DOMOPHONE_DB, PhoneIndex, normalize_phone
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд запись из БД считается актуальной в кэше процесса
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', '60'))
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', '1'))
+SESSION_FLUSH_SIZE = int(os.getenv('SESSION_FLUSH_SIZE', '100'))
+
+
+class SessionStore:
+    """Привязка чатов Telegram к жильцам в domophone.db.
+
+    Чтение идет через кэш процесса, запись копится в памяти и сбрасывается
+    в БД пачками: по таймеру или при накоплении SESSION_FLUSH_SIZE записей.
+    Кэш используется только в цикле событий, в потоках выполняются лишь запросы к БД.
+    """
+
+    def __init__(
+        self,
+        path: str = DOMOPHONE_DB,
+        cache_ttl: float = SESSION_CACHE_TTL,
+        flush_interval: float = SESSION_FLUSH_INTERVAL,
+        flush_size: int = SESSION_FLUSH_SIZE
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._by_chat = TTLCache(ttl=cache_ttl, max_entries=100000)
+        self._by_tenant = TTLCache(ttl=cache_ttl, max_entries=100000)
+        self._pending: Dict[int, Dict] = {}
+        # Пачка, которая сейчас записывается в БД: до COMMIT ее видно только здесь
+        self._flushing: Dict[int, Dict] = {}
+        # _lock - соединение с БД, _pending_lock - только короткая работа с буфером
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                chat_id INTEGER PRIMARY KEY,
+                tenant_id INTEGER NOT NULL,
+                phone TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_tenant ON sessions (tenant_id);
+            CREATE INDEX IF NOT EXISTS idx_sessions_phone ON sessions (phone);
+        ''')
+        self.phones = PhoneIndex(path)
+
+    def start(self):
+        """Запуск периодического сброса записей в БД"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+        self.phones.start()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.phones.stop()
+        await asyncio.to_thread(self.flush)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+        self.phones.close()
+
+    def save(self, chat_id: int, tenant_id: int, phone: str):
+        """Сохранение привязки чата к жильцу"""
+        if tenant_id is None:
+            raise ValueError(f"Сессия чата {chat_id} без tenant_id")
+        phone = normalize_phone(phone) or phone
+        session = {
+            'chat_id': chat_id,
+            'tenant_id': tenant_id,
+            'phone': phone,
+            'updated_at': time.time()
+        }
+        with self._pending_lock:
+            self._pending[chat_id] = session
+            flush_now = len(self._pending) >= self.flush_size
+        self.phones.add(phone, tenant_id)
+        previous = self._by_chat.get(chat_id)
+        if previous is not None:
+            self._by_tenant.invalidate(previous['tenant_id'])
+        # Сброс перед записью: чтение из БД, начатое раньше, не затрет новую сессию
+        self._by_chat.invalidate(chat_id)
+        self._by_chat.set(chat_id, session)
+        self._by_tenant.invalidate(tenant_id)
+        if flush_now:
+            # Записью в БД занимается фоновая задача, цикл событий ее не ждет
+            self._wakeup.set()
+
+    async def get(self, chat_id: int) -> Optional[Dict]:
+        """Сессия чата или None"""
+        return await self._by_chat.get_or_load(chat_id, lambda: asyncio.to_thread(self._load_chat, chat_id))
+
+    async def get_by_tenant(self, tenant_id: int) -> List[Dict]:
+        """Все чаты жильца; используется для уведомлений о вызовах"""
+        # Пустой список не кэшируется: сессию мог только что сохранить другой процесс
+        sessions = await self._by_tenant.get_or_load(
+            tenant_id, lambda: asyncio.to_thread(self._load_tenant, tenant_id)
+        )
+        return sessions or []
+
+    def _load_chat(self, chat_id: int) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT chat_id, tenant_id, phone, updated_at FROM sessions WHERE chat_id = ?',
+                (chat_id,)
+            ).fetchone()
+            with self._pending_lock:
+                session = self._pending.get(chat_id) or self._flushing.get(chat_id)
+        if session is None and row is not None:
+            session = self._row_to_session(row)
+        return session
+
+    def _load_tenant(self, tenant_id: int) -> Optional[List[Dict]]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT chat_id, tenant_id, phone, updated_at FROM sessions WHERE tenant_id = ?',
+                (tenant_id,)
+            ).fetchall()
+            with self._pending_lock:
+                unsaved = {**self._flushing, **self._pending}
+        by_chat = {row[0]: self._row_to_session(row) for row in rows}
+        for session in unsaved.values():
+            if session['tenant_id'] == tenant_id:
+                by_chat[session['chat_id']] = session
+            elif session['chat_id'] in by_chat:
+                del by_chat[session['chat_id']]
+        return list(by_chat.values()) or None
+
+    def tenant_for_phone(self, phone: str) -> Optional[int]:
+        """tenant_id по телефону в любом формате: из индекса в памяти, а если там
+        нет - из БД (сессия могла быть сохранена другим процессом после обновления индекса)"""
+        tenant_id = self.phones.tenant_for(phone)
+        if tenant_id is not None:
+            return tenant_id
+        phone = normalize_phone(phone)
+        if phone is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT tenant_id FROM sessions WHERE phone = ? ORDER BY updated_at DESC LIMIT 1',
+                (phone,)
+            ).fetchone()
+        if row is None:
+            return None
+        self.phones.add(phone, row[0])
+        return row[0]
+
+    def flush(self):
+        """Запись накопленных сессий в БД одной транзакцией"""
+        with self._lock:
+            # Буфер забирается целиком, и save() не ждет окончания записи
+            with self._pending_lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+            sessions = list(self._flushing.values())
+            try:
+                self._write(sessions)
+            except sqlite3.IntegrityError:
+                # Одна некорректная запись не должна навсегда блокировать всю пачку:
+                # записываем по одной и отбрасываем только отвергнутые
+                for session in sessions:
+                    try:
+                        self._write([session])
+                    except sqlite3.IntegrityError as e:
+                        logger.error(f"Сессия чата {session['chat_id']} не сохранена: {e}")
+            except BaseException:
+                # Пачка вернется в буфер; сессии, сохраненные за время записи, новее
+                with self._pending_lock:
+                    self._pending = {**self._flushing, **self._pending}
+                    self._flushing = {}
+                raise
+            with self._pending_lock:
+                self._flushing = {}
+
+    def _write(self, sessions: List[Dict]):
+        self._conn.execute('BEGIN')
+        try:
+            self._conn.executemany(
+                '''INSERT INTO sessions (chat_id, tenant_id, phone, updated_at)
+                   VALUES (:chat_id, :tenant_id, :phone, :updated_at)
+                   ON CONFLICT (chat_id) DO UPDATE SET
+                       tenant_id = excluded.tenant_id,
+                       phone = excluded.phone,
+                       updated_at = excluded.updated_at''',
+                sessions
+            )
+            self._conn.execute('COMMIT')
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error(f"Ошибка записи сессий: {e}")
+
+    @staticmethod
+    def _row_to_session(row) -> Dict:
+        return {'chat_id': row[0], 'tenant_id': row[1], 'phone': row[2], 'updated_at': row[3]}
@@ -0,0 +1,66 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from session_store import DOMOPHONE_DB
+
+
+class SharedCache:
+    """Кэш с TTL в SQLite, общий для всех процессов бота"""
+
+    def __init__(self, path: str = DOMOPHONE_DB, purge_every: int = 1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS shared_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_shared_cache_expires ON shared_cache (expires_at);
+        ''')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM shared_cache WHERE key = ? AND expires_at > ?',
+                (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: float):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO shared_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), now + ttl)
+            )
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self._conn.execute('DELETE FROM shared_cache WHERE expires_at <= ?', (now,))
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._conn.execute('DELETE FROM shared_cache WHERE key = ?', (key,))
+
+    def invalidate_many(self, keys):
+        """Сброс нескольких ключей одной транзакцией"""
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany('DELETE FROM shared_cache WHERE key = ?', [(key,) for key in keys])
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
@@ -0,0 +1,108 @@
+import asyncio
+import importlib.util
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Пережатие снимков включается только если установлен Pillow; иначе снимок уходит как есть
+PILLOW_AVAILABLE = importlib.util.find_spec('PIL') is not None
+# Наибольшая сторона снимка для Telegram и качество JPEG после пережатия
+SNAPSHOT_MAX_SIDE = int(os.getenv('SNAPSHOT_MAX_SIDE', '1280'))
+SNAPSHOT_JPEG_QUALITY = int(os.getenv('SNAPSHOT_JPEG_QUALITY', '80'))
+# Снимки меньше этого размера не пережимаются
+SNAPSHOT_TRANSCODE_MIN_BYTES = int(os.getenv('SNAPSHOT_TRANSCODE_MIN_BYTES', str(200 * 1024)))
+SNAPSHOT_PROCESS_WORKERS = int(os.getenv('SNAPSHOT_PROCESS_WORKERS', '2'))
+# Сколько снимков одновременно скачивается и обрабатывается; вместе с
+# SNAPSHOT_MAX_BYTES ограничивает пиковую память на снимки
+SNAPSHOT_MAX_IN_FLIGHT = int(os.getenv('SNAPSHOT_MAX_IN_FLIGHT', '8'))
+
+
+def transcode_jpeg(data: bytes, max_side: int, quality: int) -> bytes:
+    """Уменьшение и пережатие JPEG; выполняется в процессе пула"""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        # draft декодирует JPEG сразу в уменьшенном масштабе: полный кадр в память не попадает
+        image.draft('RGB', (max_side, max_side))
+        image = image.convert('RGB')
+        image.thumbnail((max_side, max_side))
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+    result = output.getvalue()
+    return result if len(result) < len(data) else data
+
+
+class SnapshotProcessor:
+    """Загрузка и пережатие снимков с камер в пуле процессов, вне цикла событий"""
+
+    def __init__(
+        self,
+        workers: int = SNAPSHOT_PROCESS_WORKERS,
+        max_in_flight: int = SNAPSHOT_MAX_IN_FLIGHT,
+        max_side: int = SNAPSHOT_MAX_SIDE,
+        quality: int = SNAPSHOT_JPEG_QUALITY,
+        min_bytes: int = SNAPSHOT_TRANSCODE_MIN_BYTES,
+        enabled: bool = PILLOW_AVAILABLE
+    ):
+        self.workers = workers
+        self.max_side = max_side
+        self.quality = quality
+        self.min_bytes = min_bytes
+        self.enabled = enabled and workers > 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.processed = 0
+        self.passed_through = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def load(self, fetch: Callable[[], Awaitable[Optional[bytes]]]) -> Optional[bytes]:
+        """Скачивание снимка и подготовка его к отправке в Telegram"""
+        async with self._slots:
+            data = await fetch()
+            if data is None:
+                return None
+            return await self.process(data)
+
+    async def process(self, data: bytes) -> bytes:
+        """Уменьшенный снимок; при ошибке или без Pillow - исходный"""
+        self.bytes_in += len(data)
+        if not self.enabled or len(data) < self.min_bytes:
+            self.passed_through += 1
+            self.bytes_out += len(data)
+            return data
+        if self._pool is None:
+            # spawn: дочерние процессы не наследуют потоки и состояние цикла событий
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self._pool, transcode_jpeg, data, self.max_side, self.quality
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось пережать снимок: {e}")
+            self.failed += 1
+            result = data
+        else:
+            self.processed += 1
+        self.bytes_out += len(result)
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'processed': self.processed,
+            'passed_through': self.passed_through,
+            'failed': self.failed,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out
+        }
@@ -0,0 +1,87 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Union
+
+from cache import TTLCache
+
+# Снимок с камеры устаревает быстро, поэтому кэшируется на несколько секунд
+SNAPSHOT_TTL = float(os.getenv('SNAPSHOT_TTL', '5'))
+# URL камеры меняется редко, его можно держать дольше самого снимка
+SNAPSHOT_URL_TTL = float(os.getenv('SNAPSHOT_URL_TTL', '60'))
+SNAPSHOT_CACHE_BYTES = int(os.getenv('SNAPSHOT_CACHE_BYTES', str(64 * 1024 * 1024)))
+
+Photo = Union[bytes, str]
+
+
+def photo_file_id(message) -> Optional[str]:
+    """file_id самого большого размера фото из отправленного сообщения"""
+    photos = getattr(message, 'photo', None)
+    if not photos:
+        return None
+    return photos[-1].file_id
+
+
+class SnapshotService:
+    """Снимки с камер для бота и webhook: кэш URL и байтов, объединение
+    одновременных запросов и повторная отправка через Telegram file_id"""
+
+    def __init__(
+        self,
+        ttl: float = SNAPSHOT_TTL,
+        max_bytes: int = SNAPSHOT_CACHE_BYTES,
+        url_ttl: float = SNAPSHOT_URL_TTL
+    ):
+        self.urls = TTLCache(ttl=url_ttl, max_entries=10000, sizeof=len)
+        self.images = TTLCache(ttl=ttl, max_entries=1000, max_bytes=max_bytes, sizeof=len)
+        self.file_ids = TTLCache(ttl=ttl, max_entries=10000, sizeof=len)
+        self._upload_locks: Dict[Hashable, asyncio.Lock] = {}
+        self.uploads = 0
+        self.reused = 0
+
+    async def get_url(self, domofon_id, load: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        """URL снимка камеры"""
+        return await self.urls.get_or_load(domofon_id, load)
+
+    async def get_bytes(self, domofon_id, load: Callable[[], Awaitable[Optional[bytes]]]) -> Optional[bytes]:
+        """JPEG снимка камеры"""
+        return await self.images.get_or_load(domofon_id, load)
+
+    async def send_photo(
+        self,
+        domofon_id,
+        load: Callable[[], Awaitable[Optional[Photo]]],
+        send: Callable[[Photo], Awaitable[Any]]
+    ) -> Optional[Any]:
+        """Отправка снимка: свежий снимок камеры загружается в Telegram один раз,
+        остальным получателям уходит его file_id. None, если снимка нет"""
+        file_id = self.file_ids.get(domofon_id)
+        if file_id is not None:
+            self.reused += 1
+            return await send(file_id)
+
+        # Замков столько же, сколько камер, поэтому они не удаляются
+        lock = self._upload_locks.setdefault(domofon_id, asyncio.Lock())
+        async with lock:
+            file_id = self.file_ids.get(domofon_id)
+            if file_id is None:
+                photo = await load()
+                if photo is None:
+                    return None
+                message = await send(photo)
+                self.uploads += 1
+                file_id = photo_file_id(message)
+                if file_id is not None:
+                    self.file_ids.set(domofon_id, file_id)
+                return message
+
+        # file_id уже есть: отправки остальным получателям идут параллельно, вне замка
+        self.reused += 1
+        return await send(file_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'urls': self.urls.stats(),
+            'images': self.images.stats(),
+            'uploads': self.uploads,
+            'file_id_reused': self.reused
+        }
@@ -1,58 +1,265 @@
-from flask import Flask, request, jsonify
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
 from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
+from contextlib import asynccontextmanager
+import asyncio
+import hmac
+import json
+import logging
 import os
+import sys
+import time
+import uvicorn
 from dotenv import load_dotenv
-from api_client import ApiClient
+from api_client import AsyncApiClient
+from notification_queue import DeliveryWorker, NotificationQueue, call_idempotency_key
+from send_scheduler import PRIORITY_CALL, TELEGRAM_CALLS_RATE_SHARE, SendScheduler
+from snapshot_service import SnapshotService
+from snapshot_processing import SnapshotProcessor
+from session_store import SessionStore
+from event_log import EVENT_CALL, EventLog
+from callbacks import ACTION_OPEN, encode_callback
+import metrics
 
 load_dotenv()
 
-app = Flask(__name__)
-bot = Bot(token=os.getenv('TELEGRAM_TOKEN'))
-api_client = ApiClient(os.getenv('DOMOPHONE_API_URL'), os.getenv('DOMOPHONE_API_TOKEN'))
+logger = logging.getLogger(__name__)
+
+# Параллельность доставки и предельная глубина очереди вызовов
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '16'))
+WEBHOOK_QUEUE_MAX_DEPTH = int(os.getenv('WEBHOOK_QUEUE_MAX_DEPTH', '100000'))
+DELIVERY_BATCH_SIZE = int(os.getenv('DELIVERY_BATCH_SIZE', '50'))
+# 0 - доставку выполняет отдельный процесс: python webhook_server.py worker
+DELIVERY_IN_PROCESS = os.getenv('DELIVERY_IN_PROCESS', '1') == '1'
+# webhook - обновления бота принимаются этим же сервером
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+BOT_WEBHOOK_SECRET = os.getenv('BOT_WEBHOOK_SECRET', '')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+
+bot = Bot(token=os.getenv('TELEGRAM_TOKEN'), base_url=TELEGRAM_API_URL)
+session_store = SessionStore()
+api_client = AsyncApiClient(
+    os.getenv('DOMOPHONE_API_URL'), os.getenv('DOMOPHONE_API_TOKEN'), phones=session_store.phones
+)
+# Бот в режиме webhook и доставка вызовов в одном процессе отправляют через один
+# планировщик, и вызовы идут раньше ответов бота. Если доставка идет отдельно от бота,
+# ей достается только доля общего лимита
+SHARED_SCHEDULER = BOT_MODE == 'webhook' and DELIVERY_IN_PROCESS
+send_scheduler = SendScheduler()
+if not SHARED_SCHEDULER:
+    send_scheduler.scale_global_rate(TELEGRAM_CALLS_RATE_SHARE)
+snapshots = SnapshotService()
+snapshot_processor = SnapshotProcessor()
+event_log = EventLog()
+# DomophoneBot, если бот работает в режиме webhook
+telegram_bot = None
+
+
+async def notify_call(event: dict):
+    """Отправка уведомления о вызове жильцу"""
+    domophone_id = event['domofon_id']
+    tenant_id = event['tenant_id']
+
+    # Чаты жильца берутся из локального хранилища сессий, без запроса к API
+    sessions = await session_store.get_by_tenant(int(tenant_id))
+    if not sessions:
+        logger.warning(f"Пользователь {tenant_id} не найден или нет telegram chat ID")
+        return
 
-@app.route('/webhook/call', methods=['POST', 'GET'])
-async def handle_call():
-    if request.method == 'GET':
-        data = request.args
-    else:
-        data = request.json
-        
-    domophone_id = data.get('domofon_id')
-    tenant_id = data.get('tenant_id')
-    
-    if not domophone_id or not tenant_id:
-        return jsonify({'error': 'Missing required parameters'}), 400
-    
-    # Получаем информацию о пользователе
-    user_info = api_client.check_tenant(tenant_id)
-    if not user_info or not user_info.get('telegram_chat_id'):
-        return jsonify({'error': 'User not found or no telegram chat ID'}), 404
-    
-    # Получаем снимок с камеры
-    snapshot = api_client.get_camera_snapshot(domophone_id, user_info.get('phone'))
-    
     # Создаем кнопку для открытия двери
     keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("Открыть дверь", callback_data=f"open_{domophone_id}")]
+        [InlineKeyboardButton("Открыть дверь", callback_data=encode_callback(ACTION_OPEN, domophone_id))]
     ])
-    
-    try:
-        if snapshot:
-            await bot.send_photo(
-                chat_id=user_info['telegram_chat_id'],
-                photo=snapshot,
+
+    await asyncio.gather(*(
+        notify_chat(session['chat_id'], session['phone'], domophone_id, keyboard, event.get('received_at'))
+        for session in sessions
+    ))
+
+
+async def load_snapshot(domophone_id, phone: str):
+    """Снимок с камеры, уменьшенный до размера для Telegram"""
+    return await snapshot_processor.load(lambda: api_client.get_camera_snapshot(domophone_id, phone))
+
+
+async def notify_chat(
+    chat_id: int,
+    phone: str,
+    domophone_id,
+    keyboard: InlineKeyboardMarkup,
+    received_at: float = None
+):
+    """Уведомление о вызове в один чат"""
+    coalesce_key = f"ring:{chat_id}:{domophone_id}"
+
+    # Повторные звонки в тот же домофон объединяются в одно уведомление, а снимок
+    # одной камеры загружается в Telegram один раз на всех жильцов подъезда
+    message = await snapshots.send_photo(
+        domophone_id,
+        lambda: snapshots.get_bytes(domophone_id, lambda: load_snapshot(domophone_id, phone)),
+        lambda photo: send_scheduler.send(
+            chat_id,
+            lambda: bot.send_photo(
+                chat_id=chat_id,
+                photo=photo,
                 caption="🔔 Входящий вызов в домофон!",
                 reply_markup=keyboard
-            )
-        else:
-            await bot.send_message(
-                chat_id=user_info['telegram_chat_id'],
+            ),
+            priority=PRIORITY_CALL,
+            coalesce_key=coalesce_key
+        )
+    )
+    if message is None:
+        await send_scheduler.send(
+            chat_id,
+            lambda: bot.send_message(
+                chat_id=chat_id,
                 text="🔔 Входящий вызов в домофон!",
                 reply_markup=keyboard
-            )
-        return jsonify({'success': True}), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+            ),
+            priority=PRIORITY_CALL,
+            coalesce_key=coalesce_key
+        )
+    if received_at is not None:
+        metrics.RING_TO_NOTIFICATION.observe(time.time() - received_at)
+
+
+notification_queue = NotificationQueue()
+delivery_worker = DeliveryWorker(
+    notification_queue,
+    notify_call,
+    concurrency=WEBHOOK_WORKERS,
+    batch_size=DELIVERY_BATCH_SIZE
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global telegram_bot
+    if BOT_MODE == 'webhook':
+        if not BOT_WEBHOOK_SECRET:
+            raise ValueError("Не задан BOT_WEBHOOK_SECRET: без него режим webhook не запускается")
+        from bot import DomophoneBot
+        telegram_bot = DomophoneBot(scheduler=send_scheduler if SHARED_SCHEDULER else None)
+        await telegram_bot.start_webhook()
+    if DELIVERY_IN_PROCESS:
+        await api_client.start()
+        await bot.initialize()
+    delivery_worker.start(deliver=DELIVERY_IN_PROCESS)
+    # Периодически подхватывает сессии и суперпользователей, сохраненные ботом
+    session_store.start()
+    event_log.start()
+    try:
+        yield
+    finally:
+        # Бот останавливается первым, пока планировщик еще отправляет его ответы
+        if telegram_bot is not None:
+            await telegram_bot.stop_webhook()
+            telegram_bot = None
+        await delivery_worker.stop()
+        await session_store.stop()
+        await event_log.stop()
+        await send_scheduler.stop()
+        snapshot_processor.close()
+        if DELIVERY_IN_PROCESS:
+            await bot.shutdown()
+            await api_client.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+metrics.register_stats('domophone_notification_queue', 'Очередь уведомлений о вызовах', delivery_worker.stats)
+metrics.register_stats('domophone_snapshot_cache', 'Кэш снимков с камер', snapshots.images.stats)
+metrics.register_stats('domophone_snapshot_processing', 'Пережатие снимков с камер', snapshot_processor.stats)
+metrics.register_stats('domophone_send_scheduler', 'Очередь отправок в Telegram', send_scheduler.stats)
+
+
+@app.api_route('/webhook/call', methods=['POST', 'GET'])
+@metrics.observe_handler('handle_call')
+async def handle_call(request: Request):
+    if request.method == 'GET':
+        data = request.query_params
+    else:
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            data = None
+        if not isinstance(data, dict):
+            return JSONResponse({'error': 'Invalid JSON body'}, status_code=400)
+
+    domophone_id = data.get('domofon_id')
+    tenant_id = data.get('tenant_id')
+
+    if not domophone_id or not tenant_id:
+        return JSONResponse({'error': 'Missing required parameters'}, status_code=400)
+    try:
+        int(tenant_id)
+    except (TypeError, ValueError):
+        return JSONResponse({'error': 'Invalid tenant_id'}, status_code=400)
+
+    if delivery_worker.depth >= WEBHOOK_QUEUE_MAX_DEPTH:
+        return JSONResponse(
+            {'error': 'Too many calls, retry later'},
+            status_code=503,
+            headers={'Retry-After': '1'}
+        )
+
+    # Снимок и уведомление доставляются в фоне, вызывающему сразу отвечаем 202
+    received_at = time.time()
+    ring_ts = data.get('ts') or int(received_at)
+    event = {
+        'domofon_id': domophone_id,
+        'tenant_id': tenant_id,
+        'ring_ts': ring_ts,
+        'received_at': received_at
+    }
+    key = call_idempotency_key(domophone_id, tenant_id, ring_ts)
+    created = await asyncio.to_thread(notification_queue.enqueue, key, event)
+    if created:
+        delivery_worker.notify()
+        event_log.append(EVENT_CALL, tenant_id, domophone_id, ts=received_at)
+    return JSONResponse({'accepted': True, 'duplicate': not created}, status_code=202)
+
+
+@app.post('/telegram/webhook')
+async def handle_telegram_update(request: Request):
+    if telegram_bot is None:
+        return JSONResponse({'error': 'Bot webhook mode is disabled'}, status_code=404)
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret.encode(), BOT_WEBHOOK_SECRET.encode()):
+        return JSONResponse({'error': 'Forbidden'}, status_code=403)
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return JSONResponse({'error': 'Invalid JSON body'}, status_code=400)
+    await telegram_bot.process_webhook_update(data)
+    return JSONResponse({'ok': True})
+
+
+@app.get('/metrics')
+async def metrics_endpoint():
+    body = await asyncio.to_thread(metrics.render)
+    return Response(body, media_type=metrics.CONTENT_TYPE)
+
+
+@app.get('/queue/stats')
+async def queue_stats():
+    return await asyncio.to_thread(delivery_worker.stats)
+
+
+async def run_delivery_worker():
+    """Доставка уведомлений отдельным процессом"""
+    async with api_client:
+        async with bot:
+            try:
+                await delivery_worker.run()
+            finally:
+                await send_scheduler.stop()
+                snapshot_processor.close()
+
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000) 
\ No newline at end of file
+    if sys.argv[1:] == ['worker']:
+        asyncio.run(run_delivery_worker())
+    else:
+        uvicorn.run(app, host='0.0.0.0', port=5000)